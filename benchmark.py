@@ -0,0 +1,331 @@
+# Offline benchmarks for the Search Term Details queries and page data path, run against a
+# synthetic copy of the warehouse tables in DuckDB (needs `pip install duckdb`).
+#
+#   python benchmark.py --searches 100000
+#   python benchmark.py --searches 100000000 --db bench.duckdb   # generated once, reused after
+
+import argparse
+import os
+import re
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import duckdb
+import pyarrow as pa
+
+import rollup
+import utils
+
+BUSINESS_ID = 1
+EXPERIENCE_KEY = "benchmark"
+MODES = ["Search Term", "Cluster"]
+
+# Snowflake functions used by the queries that DuckDB doesn't have, and a seeded random number
+# in [0, 1) for the generator so the data is the same on every run. The HLL "sketches" are lists of
+# the distinct values, so rollup reads count sessions exactly here; exporting one hashes them into
+# the registers of a real sketch, in Snowflake's HLL_EXPORT format.
+MACROS = """
+create or replace macro div0(a, b) as case when b = 0 then 0 else a / b end;
+create or replace macro dateadd(part, n, d) as d + to_days(cast(n as integer));
+create or replace macro to_varchar(x) as cast(x as varchar);
+create or replace macro hll_accumulate(x) as list(distinct x);
+create or replace macro hll_combine(x) as list_distinct(flatten(list(x)));
+create or replace macro hll_estimate(x) as len(x);
+create or replace macro hll_export(x) as (
+    select to_json({
+        'version': 4,
+        'precision': 12,
+        'sparse': {
+            'indices': coalesce(list(i order by i), []),
+            'maxLzCounts': coalesce(list(r order by i), [])
+        }
+    })
+    from (
+        select i, max(case when w = 0 then 53 else 52 - cast(floor(log2(w)) as integer) end) as r
+        from (select hash(v) >> 52 as i, hash(v) & 4503599627370495 as w from unnest(x) t(v))
+        group by i
+    )
+);
+create or replace macro rnd(i, salt) as (hash(i * 7919 + salt) % 1000000) / 1000000.0;
+"""
+
+# Synthetic tables with the columns the queries use. Term, cluster and entity popularity follow
+# power laws, so the most popular terms (the ones analysts look at) have most of the searches.
+# Searches are in time order, as they're loaded, so a filter on recent days can skip the rest.
+GENERATE = """
+create table searches as
+select
+    i as id,
+    'query-' || i as query_id,
+    {b} as business_id,
+    '{e}' as experience_key,
+    'term ' || cast(floor(pow({terms}, rnd(i, 1))) as integer) as tokenizer_normalized_query,
+    cast(current_date() as timestamp)
+        - to_days({days} - 1)
+        + to_seconds(cast(i * {days} * 86400 // {searches} as bigint)) as timestamp,
+    case when rnd(i, 4) < 0.9 then 'PRODUCTION' else 'STAGING' end as version_label,
+    rnd(i, 5) < 0.7 as has_kg_results
+from range({searches}) t(i);
+
+create table user_data as
+select
+    id as search_id,
+    'session-' || (id // 3) as session_id,
+    case when rnd(id // 3, 6) < 0.85 then 'EXTERNAL' else 'INTERNAL' end as traffic_source,
+    ['STANDARD', 'OVERLAY', 'API'][cast(floor(pow(4, rnd(id, 7))) as integer)] as query_source,
+    ['Arlington', 'New York', 'London'][1 + cast(floor(rnd(id // 3, 8) * 3) as integer)] as city,
+    ['VA', 'NY', 'ENG'][1 + cast(floor(rnd(id // 3, 8) * 3) as integer)] as region,
+    ['US', 'US', 'GB'][1 + cast(floor(rnd(id // 3, 8) * 3) as integer)] as country,
+    38.9 + rnd(id // 3, 9) as latitude,
+    -77.1 + rnd(id // 3, 10) as longitude
+from searches;
+
+create table vertical_searchers as
+select
+    searches.id * 2 + v as id,
+    searches.id as search_id,
+    ['faqs', 'products', 'locations'][1 + cast(floor(rnd(searches.id * 2 + v, 11) * 3) as integer)]
+        as vertical_id
+from searches, range(2) t(v);
+
+create table results as
+select
+    vertical_searchers.id as vertical_searcher_id,
+    (hash(searches.tokenizer_normalized_query) % 100000 + r * 7919
+        + hash(vertical_searchers.vertical_id) % 1000) % {entities} as entity_id
+from
+    vertical_searchers
+    join searches on vertical_searchers.search_id = searches.id,
+    range(5) t(r);
+
+create table user_event_types as
+select * from (values (1, true), (2, false)) t(id, is_click_event);
+
+create table user_events as
+select
+    searches.id as search_id,
+    vertical_searchers.id as vertical_searcher_id,
+    (hash(searches.tokenizer_normalized_query) % 100000
+        + (cast(floor(pow(5, rnd(searches.id, 12))) as integer) - 1) * 7919
+        + hash(vertical_searchers.vertical_id) % 1000) % {entities} as entity_id,
+    case when rnd(searches.id, 13) < 0.8 then 1 else 2 end as user_event_type_id
+from
+    searches
+    join vertical_searchers on vertical_searchers.id = searches.id * 2
+where rnd(searches.id, 14) < 0.35;
+
+create table current_cluster_search_terms as
+select
+    {b} as business_id,
+    '{e}' as experience_key,
+    cast(floor(pow({clusters}, rnd(k, 15))) as integer) as cluster_id,
+    'cluster ' || cast(floor(pow({clusters}, rnd(k, 15))) as integer) as cluster_name,
+    'term ' || k as search_term,
+    rnd(k, 16) < 0.05 as is_noise,
+    false as is_overlarge
+from range(1, {terms} + 1) t(k);
+"""
+
+# Optimization settings in utils, and the values that turn each one off
+SETTINGS = {
+    "DERIVE_DATE_WINDOWS": False,
+    "DIMENSION_FILTERS": False,
+    "COMBINED_QUERIES": False,
+    "BATCH_POPULAR_TERMS": False,
+    "INCREMENTAL_REFRESH": False,
+    "ROLLUP_QUERIES": False,
+    "SKETCH_SESSIONS": False,
+    "BIND_PARAMETERS": False,
+}
+
+# Slowest first page load allowed for the configured settings (with or without rollups), as a
+# multiple of the baseline's. They fetch the analytics for the widest date window and the results
+# for every traffic and label option, so take longer than the baseline on a cold cache.
+MAX_FIRST_LOAD_RATIO = 3
+
+# Most rows the configured settings may fetch for a first page load. Their queries are cut to the
+# rows the page can show (a day or top 10 rows for each filter combination), whatever the data size.
+MAX_FIRST_LOAD_ROWS = 2000
+
+
+def connect(path, searches):
+    conn = duckdb.connect(path or ":memory:")
+    conn.execute("set enable_progress_bar = false")
+    conn.execute(MACROS)
+    tables = conn.execute("select table_name from information_schema.tables").fetchall()
+    if ("searches",) not in tables:
+        start = time.time()
+        conn.execute(
+            GENERATE.format(
+                b=BUSINESS_ID,
+                e=EXPERIENCE_KEY,
+                searches=searches,
+                terms=max(50, searches // 200),
+                clusters=max(10, searches // 5000),
+                entities=max(1000, searches // 100),
+                days=100,
+            )
+        )
+        print(f"Generated {searches:,} searches in {time.time() - start:.1f}s")
+
+    # Rollups as the rollup job maintains them: built in full the first time, recent days after
+    start = time.time()
+    for table in rollup.BUILD_QUERIES:
+        rollup.build(conn, table, days=3)
+    print(f"Built rollups in {time.time() - start:.1f}s")
+    return conn
+
+
+def snowflake_types(table):
+    # DuckDB sums integers to 128-bit decimals, where the connector returns NUMBER(38, 0) as int64
+    columns = [
+        c.cast(pa.int64()) if pa.types.is_decimal(c.type) and c.type.scale == 0 else c
+        for c in table.columns
+    ]
+    return pa.table(columns, names=[c.upper() for c in table.column_names])
+
+
+def duckdb_sql(sql):
+    # Snowflake's numeric bind variables (:1) in DuckDB's syntax ($1)
+    return re.sub(r"(?<!:):(\d+)", r"$\1", sql)
+
+
+def run(conn, query):
+    # Arrow table of a (SQL, parameters) query's results, with Snowflake's upper case column names
+    # and types
+    sql, params = query
+    return snowflake_types(conn.execute(duckdb_sql(sql), params).fetch_arrow_table())
+
+
+def timed(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), result
+
+
+def page_filter(conn, mode, date="Last 30 Days", label="PRODUCTION", traffic="External"):
+    filter = {"b": BUSINESS_ID, "e": EXPERIENCE_KEY}
+    popular = run(conn, utils.bind_query(utils.PARAMS["popular_query"][mode], filter))
+    popular = popular[utils.PARAMS["popular_query_col"][mode]].to_pylist()
+    return {
+        **filter,
+        "s": popular[0],
+        "terms": popular,
+        "d": utils.MAP[date],
+        "l": utils.MAP[label],
+        "t": utils.MAP[traffic],
+        "traffic": traffic,
+        "label": label,
+    }
+
+
+def page_data(conn, mode, filter, cache):
+    # The demo.py data path: prefetch the analytics and every tab's query concurrently (one cursor
+    # per worker), shape each tab's frame and compute the hero indicators and line chart data.
+    # `cache` stands in for the results cache, so repeat calls only run queries they haven't seen.
+    keys = ["analytics_query", *utils.TAB_QUERIES.values()]
+    queries = {utils.details_query(k, mode, filter) for k in keys} - cache.keys()
+
+    def fetch(query):
+        return query, utils.compact(run(conn.cursor(), query))
+
+    with ThreadPoolExecutor(max_workers=utils.QUERY_WORKERS) as pool:
+        cache.update(pool.map(fetch, queries))
+
+    frames = {
+        k: utils.shape_details(k, mode, cache[utils.details_query(k, mode, filter)], filter)
+        for k in keys
+    }
+    data = frames["analytics_query"]
+    int(data["SEARCHES"].sum()), utils.total_sessions(data), int(data["CLICKS"].sum())
+    data.groupby("DATE").agg({"SEARCHES": "sum", "SESSIONS": "sum", "CLICKS": "sum"})
+    return len(queries)
+
+
+def benchmark_queries(conn, repeat):
+    print(f"\n{'query':<24}{'mode':<14}{'median ms':>10}{'rows':>10}")
+    for mode in MODES:
+        filter = page_filter(conn, mode)
+        wide = {**filter, "d": utils.WIDEST_DATE_OFFSET}
+        variants = [
+            ("", utils.PARAMS, False),
+            (" (dims)", utils.DIMENSION_PARAMS, True),
+            (" (batch)", utils.BATCH_PARAMS, False),
+            (" (rollup)", utils.ROLLUP_PARAMS, True),
+        ]
+        for suffix, params, daily in variants:
+            for key, templates in params.items():
+                if not key.endswith("_query"):
+                    continue
+                # The daily queries are fetched for the widest date window, the tabs for the selected
+                windowed = daily and key in ["analytics_query", "logs_query"]
+                query = utils.bind_query(templates[mode], wide if windowed else filter)
+                seconds, data = timed(lambda: run(conn, query), repeat)
+                print(f"{key + suffix:<24}{mode:<14}{seconds * 1000:>10.1f}{data.num_rows:>10}")
+
+
+def benchmark_page(conn, repeat):
+    print(
+        f"\n{'page data path':<24}{'mode':<14}{'first load':>12}"
+        f"{'filter change':>15}{'queries':>9}{'term change':>13}{'queries':>9}"
+    )
+    defaults = {name: getattr(utils, name) for name in SETTINGS}
+    baseline, slow = {}, []
+    for variant, settings in [
+        ("baseline", SETTINGS),
+        ("configured", defaults),
+        ("batched", {**defaults, "BATCH_POPULAR_TERMS": True}),
+        ("rollups", {**defaults, "ROLLUP_QUERIES": True}),
+    ]:
+        for name, value in settings.items():
+            setattr(utils, name, value)
+        for mode in MODES:
+            filter = page_filter(conn, mode)
+            changed = {**filter, "d": utils.MAP["Last 7 Days"], "t": utils.MAP["All Traffic"]}
+            changed["traffic"] = "All Traffic"
+            # The next term down the popular list
+            next_term = {**filter, "s": filter["terms"][1]}
+
+            first, second, third = [], [], []
+            for _ in range(repeat):
+                cache = {}
+                first.append(timed(lambda: page_data(conn, mode, filter, cache), 1)[0])
+                rows = sum(table.num_rows for table in cache.values())
+                seconds, changed_queries = timed(lambda: page_data(conn, mode, changed, cache), 1)
+                second.append(seconds)
+                seconds, term_queries = timed(lambda: page_data(conn, mode, next_term, cache), 1)
+                third.append(seconds)
+            if variant == "baseline":
+                baseline[mode] = statistics.median(first)
+            elif variant in ["configured", "rollups"]:
+                ratio = statistics.median(first) / baseline[mode]
+                if ratio > MAX_FIRST_LOAD_RATIO:
+                    slow.append(f"{variant} {mode} first load is {ratio:.1f}x the baseline's")
+                if rows > MAX_FIRST_LOAD_ROWS:
+                    slow.append(f"{variant} {mode} first load fetches {rows:,} rows")
+            print(
+                f"{variant:<24}{mode:<14}{statistics.median(first) * 1000:>10.1f}ms"
+                f"{statistics.median(second) * 1000:>13.1f}ms{changed_queries:>9}"
+                f"{statistics.median(third) * 1000:>11.1f}ms{term_queries:>9}"
+            )
+    for name, value in defaults.items():
+        setattr(utils, name, value)
+    assert not slow, "; ".join(slow)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the queries on synthetic data")
+    parser.add_argument("--searches", type=int, default=10**5, help="rows in searches (1e4 - 1e8)")
+    parser.add_argument("--db", help="DuckDB file to generate the data into once and reuse")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per timing (median is shown)")
+    args = parser.parse_args()
+
+    if args.db and os.path.exists(args.db):
+        print(f"Reusing data in {args.db}")
+    conn = connect(args.db, args.searches)
+    benchmark_queries(conn, args.repeat)
+    benchmark_page(conn, args.repeat)
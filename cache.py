@@ -0,0 +1,238 @@
+import hashlib
+import os
+import pickle
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import pyarrow as pa
+
+# Arrow IPC streams start with a continuation marker, pickles never do
+ARROW_STREAM = b"\xff\xff\xff\xff"
+
+
+def cache_key(*parts):
+    # Stable key for a query and its parameters, ignoring differences in SQL whitespace
+    normalized = [re.sub(r"\s+", " ", p).strip() if isinstance(p, str) else p for p in parts]
+    return hashlib.sha256(repr(normalized).encode()).hexdigest()
+
+
+def _dumps(value):
+    # Arrow tables are stored as IPC streams, which load straight out of the blob without copying
+    # or unpickling the data; anything else is pickled
+    if isinstance(value, pa.Table):
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, value.schema) as writer:
+            writer.write_table(value)
+        return sink.getvalue().to_pybytes()
+    return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _loads(blob):
+    if blob[:4] == ARROW_STREAM:
+        return pa.ipc.open_stream(blob).read_all()
+    return pickle.loads(blob)
+
+
+class DiskCache:
+    # Results cache in a SQLite file, shared by every worker process that points at the same path
+    # (a local stand-in for a shared store). Entries expire after `ttl` seconds and the least
+    # recently used ones are evicted once the total size passes `max_bytes`. Up to `memory_bytes`
+    # of recently used entries are also kept loaded in this process, sized by their stored blobs
+    # (which loaded Arrow tables reference rather than copy).
+
+    def __init__(self, path, ttl=600, max_bytes=1024**3, memory_bytes=0):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.memory_bytes = memory_bytes
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_used = 0
+        self._touched = {}
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._connect().execute(
+            """
+            create table if not exists entries (
+                key text primary key,
+                value blob not null,
+                size integer not null,
+                created real not null,
+                accessed real not null
+            )
+            """
+        )
+
+    def _connect(self):
+        # sqlite3 connections can't be shared between threads, so keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("pragma journal_mode=wal")
+            self._local.conn = conn
+        return conn
+
+    def _remember(self, key, value, created, size):
+        with self._lock:
+            if key in self._memory:
+                self._memory_used -= self._memory.pop(key)[2]
+            if size > self.memory_bytes:
+                return
+            self._memory[key] = (value, created, size)
+            self._memory_used += size
+            while self._memory_used > self.memory_bytes:
+                evicted_key, (_, _, evicted) = self._memory.popitem(last=False)
+                self._memory_used -= evicted
+                self._touched.pop(evicted_key, None)
+
+    def _recall(self, key):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+            return entry
+
+    def get(self, key, ttl=None, soft_ttl=None):
+        # Cached value and the time it was stored, or (None, None) if missing or older than ttl.
+        # An entry in memory older than soft_ttl (or ttl) is checked against the disk first, where
+        # another process may have stored a newer one.
+        ttl = ttl or self.ttl
+        now = time.time()
+        conn = self._connect()
+        entry = self._recall(key)
+        if entry is not None:
+            value, created, _ = entry
+            if now - created <= min(ttl, soft_ttl or ttl):
+                self._touch(key, now)
+                return value, created
+            row = conn.execute("select created from entries where key = ?", (key,)).fetchone()
+            if row is None or row[0] <= created:
+                if now - created > ttl:
+                    return None, None
+                self._touch(key, now)
+                return value, created
+
+        row = conn.execute("select value, created from entries where key = ?", (key,)).fetchone()
+        if row is None or now - row[1] > ttl:
+            return None, None
+
+        conn.execute("update entries set accessed = ? where key = ?", (now, key))
+        value = _loads(row[0])
+        self._remember(key, value, row[1], len(row[0]))
+        return value, row[1]
+
+    def _touch(self, key, now):
+        # Mark an entry served from memory as used on disk too, so the disk's LRU eviction keeps
+        # it. Done at most once a minute per entry, to keep hits off the disk.
+        with self._lock:
+            if now - self._touched.get(key, 0) < 60:
+                return
+            self._touched[key] = now
+        self._connect().execute("update entries set accessed = ? where key = ?", (now, key))
+
+    def occupancy(self):
+        # Entries and bytes held in memory by this process and on disk by all of them
+        entries, size = self._connect().execute(
+            "select count(*), coalesce(sum(size), 0) from entries"
+        ).fetchone()
+        with self._lock:
+            return {
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_used,
+                "memory_max_bytes": self.memory_bytes,
+                "disk_entries": entries,
+                "disk_bytes": size,
+                "disk_max_bytes": self.max_bytes,
+            }
+
+    def set(self, key, value):
+        blob = _dumps(value)
+        now = time.time()
+        self._remember(key, value, now, len(blob))
+
+        # Write and evict in one transaction, so readers only ever see complete entries
+        conn = self._connect()
+        conn.execute("begin immediate")
+        try:
+            conn.execute(
+                "insert or replace into entries values (?, ?, ?, ?, ?)",
+                (key, blob, len(blob), now, now),
+            )
+            conn.execute("delete from entries where created < ?", (now - self.ttl,))
+            conn.execute(
+                """
+                delete from entries where key in (
+                    select key from (
+                        select key, sum(size) over (order by accessed desc) as total
+                        from entries
+                    )
+                    where total > ?
+                )
+                """,
+                (self.max_bytes,),
+            )
+            conn.execute("commit")
+        except BaseException:
+            conn.execute("rollback")
+            raise
+
+
+class Memo:
+    # Values built from a key, kept for the `size` most recently used keys in this process. Callers
+    # share the values, so they mustn't change them.
+
+    def __init__(self, size=256):
+        self.size = size
+        self._lock = threading.Lock()
+        self._values = OrderedDict()
+
+    def get(self, key, build):
+        with self._lock:
+            if key in self._values:
+                self._values.move_to_end(key)
+                return self._values[key]
+        value = build()
+        with self._lock:
+            self._values[key] = value
+            while len(self._values) > self.size:
+                self._values.popitem(last=False)
+        return value
+
+
+class SingleFlight:
+    # Coalesces concurrent calls for the same key into one execution, whose result (or error)
+    # every caller waiting on that key shares
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+        if not leader:
+            return call.result()
+
+        # The key is released before the call is resolved, so callers woken by a failure and
+        # trying again start a new call instead of finding this one
+        try:
+            result = func()
+        except BaseException as e:
+            self._release(key)
+            call.set_exception(e)
+            raise
+        self._release(key)
+        call.set_result(result)
+        return result
+
+    def _release(self, key):
+        with self._lock:
+            del self._calls[key]
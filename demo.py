@@ -1,15 +1,29 @@
+import json
+import logging
+import threading
+import time
+import uuid
 import streamlit as st
 import pandas as pd
+import pyarrow as pa
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import plotly.graph_objects as go
 from snowflake import connector
 from yext import YextClient
+from cache import DiskCache, Memo, SingleFlight, cache_key
+from entities import EntityIndex
+from metrics import QueryMetrics, ScanLookups, format_occupancy, format_queue, format_stats
+from pool import ConnectionPool
+from scheduler import BACKGROUND, BULK, VISIBLE, Cancelled, QueryScheduler, Run, bind, enter
+from scheduler import current_priority, superseded
+from speculate import Speculator, cancel
 from utils import *
 
 st.set_page_config(page_title="Search Term Details Demo", layout="wide")
 pd.set_option("display.max_columns", None)
 
-# Get query parameters
-QUERY_PARAMS = st.experimental_get_query_params()
+# Get query parameters, as lists of values like the URL can hold
+QUERY_PARAMS = {k: st.query_params.get_all(k) for k in st.query_params}
 
 # Set initial query param values
 def _check_param(k, default):
@@ -23,7 +37,7 @@ def _update_params(k, v=None):
         v = st.session_state[k]
 
     QUERY_PARAMS[k] = [str(v)]
-    st.experimental_set_query_params(**QUERY_PARAMS)
+    st.query_params.from_dict(QUERY_PARAMS)
 
 
 # Sidebar Inputs
@@ -70,8 +84,13 @@ MODE = st.sidebar.selectbox(
 )
 
 
-@st.experimental_singleton
-def _init_connection():
+# Queries bind their parameters as :1, :2, ... (see bind_query)
+connector.paramstyle = "numeric"
+
+logger = logging.getLogger(__name__)
+
+
+def _connect():
     return connector.connect(
         authenticator="https://yext.okta.com",
         account=st.secrets["snowflake"]["account"],
@@ -81,31 +100,385 @@ def _init_connection():
     )
 
 
+# Connections shared by every session, borrowed one per query
+@st.cache_resource
+def _init_connection_pool():
+    return ConnectionPool(_connect, size=POOL_SIZE, timeout=POOL_TIMEOUT)
+
+
 # Connect to Yext Client (for results)
-@st.experimental_singleton
+@st.cache_resource
 def _init_yext_client(API_KEY):
     return YextClient(API_KEY, env="PRODUCTION")
 
 
-YEXT_CLIENT = _init_yext_client(API_KEY)
-CONN = _init_connection()
+# Query results cache shared by every worker process on the host
+@st.cache_resource
+def _init_cache():
+    return DiskCache(
+        CACHE_PATH, ttl=CACHE_TTL, max_bytes=CACHE_MAX_BYTES, memory_bytes=MEMORY_CACHE_BYTES
+    )
 
 
-@st.experimental_memo(ttl=600)
-def get_data(query):
-    with CONN.cursor() as curs:
-        curs.execute(query)
-        return curs.fetch_pandas_all()
+# Result entity names shared by every worker process on the host
+@st.cache_resource
+def _init_entity_index():
+    return EntityIndex(ENTITY_INDEX_PATH, ttl=ENTITY_TTL, miss_ttl=ENTITY_MISS_TTL)
 
 
-@st.experimental_memo(ttl=600)
-def get_results(search_term):
+# Figures and frames derived from query results, shared by every session showing the same data
+@st.cache_resource
+def _init_memo():
+    return Memo(size=RENDER_MEMO_SIZE)
+
+
+# Keys of stale cache entries currently being refreshed, across sessions, and the lock sessions
+# take to claim one
+@st.cache_resource
+def _init_refreshing():
+    return set(), threading.Lock()
+
+
+# Queries and searches in flight, so concurrent sessions asking for the same one share it
+@st.cache_resource
+def _init_flights():
+    return SingleFlight()
+
+
+# Query timing and cost stats, also logged to a file
+@st.cache_resource
+def _init_metrics():
+    return QueryMetrics(METRICS_PATH, max_bytes=METRICS_MAX_BYTES)
+
+
+# Worker pool for running Snowflake queries concurrently
+@st.cache_resource
+def _init_query_pool():
+    return ThreadPoolExecutor(max_workers=QUERY_WORKERS)
+
+
+# Admission to the warehouse for every session's queries, most urgent first
+@st.cache_resource
+def _init_scheduler():
+    return QueryScheduler(limit=WAREHOUSE_CONCURRENCY, timeout=POOL_TIMEOUT)
+
+
+# Worker pool for Yext searches, so they run alongside the Snowflake queries
+@st.cache_resource
+def _init_search_pool():
+    return ThreadPoolExecutor(max_workers=SEARCH_WORKERS)
+
+
+# Worker pool loading the parts of each page in the background, so each shows once its data lands
+@st.cache_resource
+def _init_render_pool():
+    return ThreadPoolExecutor(max_workers=RENDER_WORKERS)
+
+
+# Background threads and query budget for warming the terms likely to be opened next
+@st.cache_resource
+def _init_speculator():
+    return Speculator(workers=SPECULATIVE_WORKERS, budget=SPECULATIVE_BUDGET, period=60)
+
+
+YEXT_CLIENT = _init_yext_client(API_KEY)
+CONN_POOL = _init_connection_pool()
+QUERY_POOL = _init_query_pool()
+SEARCH_POOL = _init_search_pool()
+RENDER_POOL = _init_render_pool()
+CACHE = _init_cache()
+ENTITY_INDEX = _init_entity_index()
+MEMO = _init_memo()
+REFRESHING, REFRESHING_LOCK = _init_refreshing()
+FLIGHTS = _init_flights()
+METRICS = _init_metrics()
+SPECULATOR = _init_speculator()
+SCHEDULER = _init_scheduler()
+
+# This run supersedes the session's last one, whose queued background queries are dropped
+if "run" in st.session_state:
+    SCHEDULER.supersede(st.session_state["run"])
+RUN = st.session_state["run"] = Run(st.session_state.setdefault("session", uuid.uuid4().hex))
+enter(RUN)
+
+
+def _scanned(query_ids):
+    # Bytes scanned by a batch of finished queries, in one query history lookup
+    sql = QUERY_HISTORY_QUERY.format(ids=", ".join(f":{i}" for i in range(1, len(query_ids) + 1)))
+
+    def run(conn):
+        with conn.cursor() as curs:
+            curs.execute(sql, query_ids)
+            return dict(curs.fetchall())
+
+    return SCHEDULER.run(lambda: CONN_POOL.run(run))
+
+
+# Bytes scanned lookups, batched on a thread of their own at bulk priority
+@st.cache_resource
+def _init_scan_lookups():
+    return ScanLookups(bind(_scanned, BULK), METRICS, period=SCAN_LOOKUP_PERIOD)
+
+
+SCANS = _init_scan_lookups()
+
+
+def _run_query(query):
+    # Run a (SQL, parameters) query from bind_query
+    sql, params = query
+
+    def run(conn):
+        with conn.cursor() as curs:
+            start = time.time()
+            curs.execute(sql, params)
+            table = curs.fetch_arrow_all()
+            # The connector returns no table for an empty result
+            if table is None:
+                table = pa.table({column[0]: [] for column in curs.description})
+            return compact(table), curs.sfqid, time.time() - start
+
+    key = cache_key("get_data", *query)
+    start = time.time()
+    data, query_id, seconds = SCHEDULER.run(lambda: CONN_POOL.run(run), key)
+    queued = time.time() - start - seconds
+    METRICS.record(key, query_id=query_id, warehouse_seconds=seconds, queued_seconds=queued)
+    METRICS.record("scheduler", **SCHEDULER.stats())
+    SCANS.add(key, query_id)
+    return data
+
+
+def _load(key, fetch):
+    data = fetch()
+    CACHE.set(key, data)
+    METRICS.record("cache", **CACHE.occupancy())
+    return data
+
+
+def _shared(key, fetch):
+    # Lead or join the fetch for key, at the caller's priority if that's more urgent. A fetch
+    # dropped because its leader's run was superseded is started again by callers still waiting.
+    SCHEDULER.promote(key, current_priority())
+    while True:
+        try:
+            return FLIGHTS.do(key, lambda: _load(key, fetch))
+        except Cancelled:
+            if superseded():
+                raise
+
+
+def _revalidate(key, fetch):
+    # Fetch a stale result again in the background and swap it into the cache. The refresh serves
+    # every session, so it isn't dropped with the run that noticed it.
+    def refresh():
+        try:
+            _shared(key, fetch)
+        finally:
+            with REFRESHING_LOCK:
+                REFRESHING.discard(key)
+
+    with REFRESHING_LOCK:
+        if key in REFRESHING:
+            return
+        REFRESHING.add(key)
+    QUERY_POOL.submit(bind(refresh, BACKGROUND))
+
+
+def _fetcher(query, refresh, data, created):
+    # Brings a cached result up to date with `refresh` when there is one, else re-runs the query
+    if refresh is not None and data is not None:
+        return lambda: refresh(data, created)
+    return lambda: _run_query(query)
+
+
+def get_data(query, ttl=QUERY_TTLS["default"], refresh=None):
+    # Arrow table of a (SQL, parameters) query's results, cached by both. `refresh(data, created)`
+    # brings a stale result up to date instead of re-running the query. Sessions missing the same
+    # result share one fetch, and the table itself, since Arrow tables are immutable.
+    start = time.time()
+    soft_ttl, hard_ttl = ttl
+    key = cache_key("get_data", *query)
+    data, created = CACHE.get(key, CACHE_TTL if refresh else hard_ttl, soft_ttl)
+    fetch = _fetcher(query, refresh, data, created)
+    if data is None:
+        status = "cache miss"
+        data = _shared(key, fetch)
+    elif time.time() - created > hard_ttl:
+        status = "topped up"
+        data = _shared(key, fetch)
+    elif time.time() - created > soft_ttl:
+        status = "stale cache hit"
+        _revalidate(key, fetch)
+        data = mark_refreshed(data, created)
+    else:
+        status = "cache hit"
+
+    METRICS.record(
+        key,
+        status=status,
+        seconds=time.time() - start,
+        rows=data.num_rows,
+        bytes=data.nbytes,
+    )
+    return data
+
+
+def _search(search_term):
     # Run search term as a query to get entities and names
     results = YEXT_CLIENT.search_answers_universal(query=search_term, experience_key=EXPERIENCE_KEY)
-    response = results.raw_response["response"]
+    return results.raw_response["response"]
+
+
+def get_results(search_term):
+    # Search response for the term in this experience, cached for SEARCH_TTL and shared by every
+    # session (and panel) searching for it at once
+    key = cache_key("get_results", EXPERIENCE_KEY, search_term)
+    response, _ = CACHE.get(key, SEARCH_TTL)
+    if response is None:
+        response = FLIGHTS.do(key, lambda: _load(key, lambda: _search(search_term)))
     return response
 
 
+def search(search_term):
+    # Start a search without waiting for it. get_results calls for the term join it while it's in
+    # flight, and find its response cached after.
+    return SEARCH_POOL.submit(get_results, search_term)
+
+
+def _fetch_names(uids):
+    # Names of one batch of entities, in a single entities API request
+    entity_filter = {"$or": [{"uid": {"$eq": uid}} for uid in uids]}
+    entities = YEXT_CLIENT.get_all_entities(
+        params={"filter": json.dumps(entity_filter), "fields": "name", "limit": ENTITY_BATCH}
+    )
+    return {str(e["meta"]["uid"]): e.get("name", "") for e in entities}
+
+
+def search_names(response):
+    # {uid: name} for the entities in a search response
+    km_modules = [m for m in response["modules"] if m["source"] == "KNOWLEDGE_MANAGER"]
+    all_entities = [r["data"] for r in flatten([m["results"] for m in km_modules]) if "data" in r]
+    return {str(d["uid"]): d["name"] for d in all_entities if "uid" in d and "name" in d}
+
+
+def entity_names(uids):
+    # {uid: name} for the entities, fetching the ones missing from the index (or stale) in batches
+    # run alongside each other. Sessions asking for the same batch at once share the request. Names
+    # are indexed per API key. A failed lookup (e.g. a key without entities API access) is logged
+    # and indexed as misses, so it's retried after ENTITY_MISS_TTL rather than on every rerun.
+    account = cache_key("entities", API_KEY)
+    stale = ENTITY_INDEX.stale(account, uids)
+    batches = [stale[i : i + ENTITY_BATCH] for i in range(0, len(stale), ENTITY_BATCH)]
+
+    def lookup(batch):
+        try:
+            names = _fetch_names(batch)
+        except Exception:
+            logger.exception("Entity name lookup failed for %d entities", len(batch))
+            names = {}
+        ENTITY_INDEX.update(account, batch, names)
+
+    def fetch(batch):
+        FLIGHTS.do(cache_key("entity_names", account, *batch), lambda: lookup(batch))
+
+    list(SEARCH_POOL.map(fetch, batches))
+    return ENTITY_INDEX.names(account, uids)
+
+
+def prefetch(keys, filter):
+    # Start the queries serving these PARAMS keys at once to warm the cache. The page doesn't wait
+    # for them: its own get_details calls join the fetches in flight, and raise any errors again.
+    queries = {args[0]: args for args in (details_args(k, filter) for k in keys)}
+    for args in queries.values():
+        QUERY_POOL.submit(bind(get_data, BACKGROUND, RUN), *args)
+
+
+def _warm(query, ttl, refresh):
+    # Fetch a result into the cache unless it's there already or the budget is spent. Errors are
+    # dropped; the page fetches the result itself if it's opened.
+    key = cache_key("get_data", *query)
+    data, _ = CACHE.get(key, CACHE_TTL if refresh else ttl[1], ttl[0])
+    if data is None and SPECULATOR.spend():
+        _shared(key, lambda: _run_query(query))
+
+
+def _warm_terms(terms, filter, tab):
+    # Warm the analytics and a tab of each term, one speculative task per query
+    keys = ["analytics_query", TAB_QUERIES[tab]]
+    queries = {}
+    for t in terms:
+        for args in (details_args(k, {**filter, "s": t}) for k in keys):
+            queries[args[0]] = args
+    return [SPECULATOR.submit(bind(_warm, BACKGROUND, RUN), *args) for args in queries.values()]
+
+
+def _warm_related(futures, popular, term, filter, tab):
+    # Warm the related terms that are on the popular list too, once the cluster query (usually
+    # prefetched) says which they are. Errors are dropped, as in _warm.
+    following = likely_terms(popular, term, [], SPECULATIVE_TERMS)
+    try:
+        related = get_details("cluster_query", filter, ["SEARCH_TERM"])["SEARCH_TERM"].tolist()
+    except Exception:
+        return
+    terms = likely_terms(popular, term, related, SPECULATIVE_TERMS)[len(following) :]
+    if terms and not superseded():
+        futures.extend(_warm_terms(terms, filter, tab))
+
+
+def speculate(popular, term, filter, tab):
+    # Warm the analytics and a tab of the terms likely to be opened next in the background,
+    # returning the futures (added to as related terms are found) so the next run can cancel any
+    # that haven't started. Related terms only apply to search terms: a cluster's terms are never
+    # on the popular list of clusters.
+    futures = _warm_terms(likely_terms(popular, term, [], SPECULATIVE_TERMS), filter, tab)
+    if MODE == "Search Term":
+        futures.append(
+            SPECULATOR.submit(
+                bind(_warm_related, BACKGROUND, RUN), futures, popular, term, filter, tab
+            )
+        )
+    return futures
+
+
+def show_query(title, key, filter):
+    # SQL serving a PARAMS key, with the stats of its latest run
+    sql, params = details_query(key, MODE, filter)
+    st.write(f"{title}:")
+    st.code(sql, language="sql")
+    if params:
+        st.caption(", ".join(f":{i} = {v!r}" for i, v in enumerate(params, 1)))
+    st.caption(format_stats(METRICS.latest(cache_key("get_data", sql, params))))
+
+
+def show_refreshed(container, data):
+    # Mark results served from a stale cache entry while they're refreshed
+    if "refreshed" in data.attrs:
+        minutes = int((time.time() - data.attrs["refreshed"]) // 60)
+        container.caption(f"Refreshed {minutes} minutes ago, updating in the background.")
+
+
+def details_ttl(key):
+    return QUERY_TTLS.get(key, QUERY_TTLS["default"])
+
+
+def _top_up(key, filter):
+    # Refresh for daily results: fetch only the days since the last complete one and merge them in
+    def refresh(data, created):
+        query, d = top_up_query(key, MODE, filter, created)
+        return compact(to_table(merge_daily(key, to_frame(data), to_frame(_run_query(query)), d)))
+
+    return refresh
+
+
+def details_args(key, filter):
+    # get_data arguments for the query serving a PARAMS key
+    refresh = _top_up(key, filter) if is_incremental(key) else None
+    return details_query(key, MODE, filter), details_ttl(key), refresh
+
+
+def get_details(key, filter, columns=None):
+    return shape_details(key, MODE, get_data(*details_args(key, filter)), filter, columns)
+
+
 def get_result_card(result):
     return f"""
         **Entity ID:** {result['data']['id']} \n
@@ -113,6 +486,352 @@ def get_result_card(result):
         """
 
 
+def load(func, *args):
+    # Start func on the render pool for this run, at the priority of the queries the page waits on
+    return RENDER_POOL.submit(bind(func, VISIBLE, RUN), *args)
+
+
+def show_parts(parts, held=None):
+    # Fill page slots ({future: [(slot, show), ...]}) as soon as each future's data lands (in page
+    # order without PROGRESSIVE_RENDERING). A slot that fails shows its error in place, without
+    # taking the rest of the page down. During a full run the panels' parts are held (in the
+    # session's `held`, passed to its fragments) for the page to fill with its own, so none waits on
+    # another; the page takes them out of `held`, so a panel rerunning alone fills its own.
+    if held is not None and "parts" in held:
+        held["parts"].update(parts)
+        return
+    for future in as_completed(parts) if PROGRESSIVE_RENDERING else parts:
+        for slot, show in parts[future]:
+            with slot.container():
+                try:
+                    show(future.result())
+                except Exception as e:
+                    st.exception(e)
+
+
+def load_tab(tab, filter):
+    # The active tab's table, ready to show
+    if tab == "Related Search Terms":
+        return get_details(
+            "cluster_query", filter, ["SEARCH_TERM", "SEARCHES", "SESSIONS", "CLICKS", "CTR"]
+        )
+
+    if tab == "Most Popular Results":
+        results_data = get_details(
+            "results_query", filter, ["ENTITY_ID", "SEARCHES", "SESSIONS", "CLICKS", "CTR"]
+        )
+
+        # Names from the term's search response (as the results tab used to show) for entities
+        # the entities API doesn't name
+        response = search(filter["s"])
+        id_name_dict = entity_names(results_data["ENTITY_ID"].dropna().astype(str))
+        try:
+            id_name_dict = {**search_names(response.result()), **id_name_dict}
+        except Exception:
+            logger.exception("Search for entity names failed")
+
+        ids = results_data["ENTITY_ID"].astype(str)
+        results_data["NAME"] = ids.map(id_name_dict).fillna("")
+        results_data["ENTITY_ID"] = make_links(
+            ids, f"https://www.yext.com/s/{BUSINESS_ID}/entity/edit3?entityIds={{}}"
+        )
+        return results_data[["ENTITY_ID", "NAME", "SEARCHES", "SESSIONS", "CLICKS", "CTR"]]
+
+    if tab == "Search Logs":
+        log_data = get_details("logs_query", filter)
+
+        log_data["QUERY_ID"] = make_links(
+            log_data["QUERY_ID"],
+            f"https://www.yext.com/s/{BUSINESS_ID}/answers/experiences/{EXPERIENCE_KEY}/searchQueryLogDetails/{{}}",
+        )
+        return log_data
+
+    return get_details(TAB_QUERIES[tab], filter) if tab in TAB_QUERIES else None
+
+
+def hero_figure(data):
+    heros = go.Figure()
+    heros.add_trace(
+        go.Indicator(
+            value=int(data["SEARCHES"].sum()), title="Searches", domain={"row": 0, "column": 0}
+        )
+    )
+    heros.add_trace(
+        go.Indicator(value=total_sessions(data), title="Sessions", domain={"row": 0, "column": 1})
+    )
+    heros.add_trace(
+        go.Indicator(
+            value=int(data["CLICKS"].sum()), title="Clicks", domain={"row": 0, "column": 2}
+        )
+    )
+    try:
+        avg_ctr = round(data["CTR"].dot(data["SEARCHES"]) / data["SEARCHES"].sum(), 2)
+    except:
+        avg_ctr = 0
+    heros.add_trace(
+        go.Indicator(
+            value=avg_ctr,
+            title="CTR",
+            domain={"row": 0, "column": 3},
+        )
+    )
+    try:
+        avg_kg_result = round(
+            data["KG_RESULT_RATE"].dot(data["SEARCHES"]) / data["SEARCHES"].sum(), 2
+        )
+    except:
+        avg_kg_result = 0
+    heros.add_trace(
+        go.Indicator(
+            value=avg_kg_result,
+            title="KG Result Rate",
+            domain={"row": 0, "column": 4},
+        )
+    )
+
+    heros.update_layout(grid={"rows": 1, "columns": 5}, margin=dict(t=0, b=0, pad=0), height=200)
+    return heros
+
+
+def line_figure(data):
+    line_data = data.groupby("DATE").agg({"SEARCHES": sum, "SESSIONS": sum, "CLICKS": sum})
+    line_graph = go.Figure()
+    line_graph.add_trace(
+        go.Scatter(
+            x=line_data.index,
+            y=line_data["SEARCHES"],
+            name="Searches",
+            hoverinfo="name+y",
+            line_shape="spline",
+        )
+    )
+    line_graph.add_trace(
+        go.Scatter(
+            x=line_data.index,
+            y=line_data["SESSIONS"],
+            name="Sessions",
+            hoverinfo="name+y",
+            line_shape="spline",
+        )
+    )
+    line_graph.add_trace(
+        go.Scatter(
+            x=line_data.index,
+            y=line_data["CLICKS"],
+            name="Clicks",
+            hoverinfo="name+y",
+            line_shape="spline",
+        )
+    )
+    line_graph.update_layout(margin=dict(t=0, b=0, pad=0))
+    return line_graph
+
+
+def show_heroes(data):
+    # Figures are rebuilt only when the analytics change, not on every rerun
+    heros = MEMO.get(("heroes", fingerprint(data)), lambda: hero_figure(data))
+    st.plotly_chart(heros, use_container_width=True)
+
+
+def show_chart(data):
+    line_graph = MEMO.get(("line_graph", fingerprint(data)), lambda: line_figure(data))
+    st.plotly_chart(line_graph, use_container_width=True)
+    show_refreshed(st, data)
+
+
+def show_table(data, page):
+    # A table as HTML, TABLE_PAGE_ROWS rows at a time when it's longer (the page picked in the tab
+    # panel, up to the last). Rendered pages are memoized on the frame, so reruns showing the same
+    # results don't format them again.
+    pages = max(1, -(-len(data.index) // TABLE_PAGE_ROWS))
+    page = min(page, pages)
+    if pages > 1:
+        st.caption(f"Page {page} of {pages}")
+    start = (page - 1) * TABLE_PAGE_ROWS
+
+    def render():
+        rows = data.iloc[start : start + TABLE_PAGE_ROWS]
+        return rows.to_html(index=False, escape=False, justify="left")
+
+    st.write(MEMO.get(("table", MODE, fingerprint(data), page), render), unsafe_allow_html=True)
+
+
+def show_tab(tab, data, filter, page):
+    # Related Search Terms Module
+    if tab == "Related Search Terms":
+        if MODE == "Search Term":
+            st.write("Other search terms in the same cluster as this search term.")
+        else:
+            st.write("Search terms in this cluster.")
+
+        if len(data.index) != 0:
+            show_table(data, page)
+        else:
+            if MODE == "Search Term":
+                st.write("_Search term is not part of a cluster._")
+            else:
+                st.write("No search terms in this cluster for the selected filters.")
+
+        show_refreshed(st, data)
+        st.markdown("""---""")
+        with st.expander("Snowflake Queries", expanded=False):
+            show_query("Analytics Overview", "analytics_query", filter)
+            show_query("Details Query", "cluster_query", filter)
+
+    # Most Popular Results Module
+    elif tab == "Most Popular Results":
+        st.write(f"The most clicked results for this {MODE.lower()}, sorted by popularity.")
+
+        if len(data.index) != 0:
+            show_table(data, page)
+        else:
+            st.write(
+                f"_No entities have been clicked for this {MODE.lower()} with the selected"
+                " filters._"
+            )
+
+        show_refreshed(st, data)
+        st.markdown("""---""")
+        with st.expander("Snowflake Queries", expanded=False):
+            show_query("Analytics Overview", "analytics_query", filter)
+            show_query("Details Query", "results_query", filter)
+
+    # Most Popular Vertical Module
+    elif tab == "Most Popular Verticals":
+        st.write(f"The most clicked verticals for this {MODE.lower()}, sorted by popularity.")
+
+        if len(data.index) != 0:
+            show_table(data, page)
+        else:
+            st.write(
+                f"_No verticals clicked for this {MODE.lower()} with the selected filters._"
+            )
+
+        show_refreshed(st, data)
+        st.markdown("""---""")
+        with st.expander("Snowflake Queries", expanded=False):
+            show_query("Analytics Overview", "analytics_query", filter)
+            show_query("Details Query", "vertical_query", filter)
+
+    # Integration Source Module
+    elif tab == "Integration Source":
+        st.write("Search volume and engagement by custom integration source.")
+
+        if len(data.index) != 0:
+            show_table(data, page)
+        else:
+            st.write(
+                f"_No searches on any integration sources for this {MODE.lower()} with the selected"
+                " filters._"
+            )
+
+        show_refreshed(st, data)
+        st.markdown("""---""")
+        with st.expander("Snowflake Queries", expanded=False):
+            show_query("Analytics Overview", "analytics_query", filter)
+            show_query("Details Query", "source_query", filter)
+
+    # Search Log Module
+    elif tab == "Search Logs":
+        st.write(f"A log of the most recent searches for this {MODE.lower()}.")
+
+        if len(data.index) != 0:
+            show_table(data, page)
+        else:
+            st.write(f"_No recent searches this {MODE.lower()} with the selected filters._")
+
+        show_refreshed(st, data)
+        st.markdown("""---""")
+        with st.expander("Snowflake Queries", expanded=False):
+            show_query("Analytics Overview", "analytics_query", filter)
+            show_query("Details Query", "logs_query", filter)
+    else:
+        st.error("Something has gone terribly wrong.")
+
+
+def show_search(response):
+    km_modules = [m for m in response["modules"] if m["source"] == "KNOWLEDGE_MANAGER"]
+    verticals = [m["verticalConfigId"] for m in km_modules]
+    results = [m["results"] for m in km_modules]
+    results_dict = dict(zip(verticals, results))
+    all_results = flatten(results)
+    all_entities = [r["data"] for r in all_results if "data" in r]
+
+    for vertical in results_dict:
+        st.warning(f"**{vertical}**")
+        count = 0
+        for result in results_dict[vertical]:
+            if count > 4:
+                break
+            st.info(get_result_card(result))
+            count += 1
+
+
+@st.fragment
+def tab_panel(filter, held):
+    # Tab picker and the active tab, rerun alone when the tab changes
+    active_tab = st.radio("Tab", TABS, index=0, key="tabs", label_visibility="collapsed")
+    child = TABS.index(active_tab) + 1
+    st.markdown(
+        """
+            <style type="text/css">
+            div[role=radiogroup] > label > div:first-of-type, .stRadio > label {
+                display: none;
+            }
+            div[role=radiogroup] {
+                flex-direction: unset
+            }
+            div[role=radiogroup] label {
+                border-bottom: 1px solid #999;
+                background: #FFF !important;
+                padding: 4px 12px;
+                border-radius: 4px 4px 0 0;
+                position: relative;
+                top: 8px;
+                font-size: 18px;
+                font-weight: bold !important;
+                }
+            div[role=radiogroup] label:nth-child("""
+        + str(child)
+        + """) {
+                background: #FFF !important;
+                border-bottom: 2px solid #1564F9;
+                font-weight: 900;
+            }
+            </style>
+        """,
+        unsafe_allow_html=True,
+    )
+    # The table's page is picked here rather than with the table, which a full run shows from
+    # outside the fragment, so paging reruns only the panel
+    _, page_column = st.columns([4, 1])
+    page = page_column.number_input("Page", min_value=1, key=f"{active_tab} page")
+    tab_slot = st.empty()
+    tab_slot.caption("Loading...")
+    show_parts(
+        {
+            load(load_tab, active_tab, filter): [
+                (tab_slot, lambda data: show_tab(active_tab, data, filter, page)),
+            ]
+        },
+        held,
+    )
+
+
+@st.fragment
+def test_search_panel(term, held):
+    # Test Search, rerun alone when the search changes
+    st.write("#### **Test Search**")
+    test_search_term = st.text_input(
+        "Test search", f"{term}", key="test_search", label_visibility="collapsed"
+    )
+    st.markdown("""---""")
+    search_slot = st.empty()
+    if test_search_term:
+        search_slot.caption("Searching...")
+        show_parts({search(test_search_term): [(search_slot, show_search)]}, held)
+
+
 # Check if existing filters selected in query params
 _check_param("d", "Last 30 Days")
 _check_param("l", "PRODUCTION")
@@ -126,9 +845,11 @@ filter = {
     "l": MAP[QUERY_PARAMS["l"][0]],
     "t": MAP[QUERY_PARAMS["t"][0]],
 }
-popular = get_data(PARAMS["popular_query"][MODE].format(**filter))[
-    PARAMS["popular_query_col"][MODE]
-].tolist()
+popular = (
+    get_data(bind_query(PARAMS["popular_query"][MODE], filter), details_ttl("popular_query"))
+    .column(PARAMS["popular_query_col"][MODE])
+    .to_pylist()
+)
 
 # Display Search Terms Select
 _check_param("s", popular[0])
@@ -192,281 +913,45 @@ filter = {
     "d": MAP[st.session_state.d],
     "l": MAP[st.session_state.l],
     "t": MAP[st.session_state.t],
+    "traffic": st.session_state.t,
+    "label": st.session_state.l,
+    "terms": popular,
 }
-data = get_data(PARAMS["analytics_query"][MODE].format(**filter))
-
-heros = go.Figure()
-heros.add_trace(
-    go.Indicator(
-        value=int(data["SEARCHES"].sum()), title="Searches", domain={"row": 0, "column": 0}
-    )
-)
-heros.add_trace(
-    go.Indicator(
-        value=int(data["SESSIONS"].sum()), title="Sessions", domain={"row": 0, "column": 1}
-    )
-)
-heros.add_trace(
-    go.Indicator(value=int(data["CLICKS"].sum()), title="Clicks", domain={"row": 0, "column": 2})
-)
-try:
-    avg_ctr = round(data["CTR"].dot(data["SEARCHES"]) / data["SEARCHES"].sum(), 2)
-except:
-    avg_ctr = 0
-heros.add_trace(
-    go.Indicator(
-        value=avg_ctr,
-        title="CTR",
-        domain={"row": 0, "column": 3},
-    )
-)
-try:
-    avg_kg_result = round(data["KG_RESULT_RATE"].dot(data["SEARCHES"]) / data["SEARCHES"].sum(), 2)
-except:
-    avg_ctr = 0
-heros.add_trace(
-    go.Indicator(
-        value=avg_kg_result,
-        title="KG Result Rate",
-        domain={"row": 0, "column": 4},
-    )
-)
 
-heros.update_layout(grid={"rows": 1, "columns": 5}, margin=dict(t=0, b=0, pad=0), height=200)
-analytics.plotly_chart(heros, use_container_width=True)
-
-line_data = data.groupby("DATE").agg({"SEARCHES": sum, "SESSIONS": sum, "CLICKS": sum})
-line_graph = go.Figure()
-line_graph.add_trace(
-    go.Scatter(
-        x=line_data.index,
-        y=line_data["SEARCHES"],
-        name="Searches",
-        hoverinfo="name+y",
-        line_shape="spline",
-    )
-)
-line_graph.add_trace(
-    go.Scatter(
-        x=line_data.index,
-        y=line_data["SESSIONS"],
-        name="Sessions",
-        hoverinfo="name+y",
-        line_shape="spline",
-    )
-)
-line_graph.add_trace(
-    go.Scatter(
-        x=line_data.index,
-        y=line_data["CLICKS"],
-        name="Clicks",
-        hoverinfo="name+y",
-        line_shape="spline",
-    )
-)
-line_graph.update_layout(margin=dict(t=0, b=0, pad=0))
-analytics.plotly_chart(line_graph, use_container_width=True)
+# Anything still queued to warm from the last run is for a page the analyst has moved on from
+cancel(st.session_state.get("speculation", []))
+
+# Fetch the analytics and every tab's details together, so switching tabs is served from cache.
+# The page waits only on the analytics, the active tab and the test search, each in the background.
+prefetch(["analytics_query", *TAB_QUERIES.values()], filter)
+
+# Lay the page out with a slot for each part, then fill the slots as their data lands below
+hero_slot = analytics.empty()
+chart_slot = analytics.empty()
+hero_slot.caption("Loading...")
+# The page's parts, and the panels' while the page lays out (see show_parts)
+held = {
+    "parts": {
+        load(get_details, "analytics_query", filter): [
+            (hero_slot, show_heroes),
+            (chart_slot, show_chart),
+        ]
+    }
+}
 
 analytics.markdown("""---""")
+with analytics:
+    tab_panel(filter, held)
+with test_search:
+    test_search_panel(term, held)
 
-active_tab = analytics.radio("", TABS, index=0, key="tabs")
-child = TABS.index(active_tab) + 1
-analytics.markdown(
-    """
-        <style type="text/css">
-        div[role=radiogroup] > label > div:first-of-type, .stRadio > label {
-            display: none;
-        }
-        div[role=radiogroup] {
-            flex-direction: unset
-        }
-        div[role=radiogroup] label {
-            border-bottom: 1px solid #999;
-            background: #FFF !important;
-            padding: 4px 12px;
-            border-radius: 4px 4px 0 0;
-            position: relative;
-            top: 8px;
-            font-size: 18px;
-            font-weight: bold !important;
-            }
-        div[role=radiogroup] label:nth-child("""
-    + str(child)
-    + """) {
-            background: #FFF !important;
-            border-bottom: 2px solid #1564F9;
-            font-weight: 900;
-        }
-        </style>
-    """,
-    unsafe_allow_html=True,
-)
+show_parts(held.pop("parts"))
+active_tab = st.session_state.tabs
 
-# Related Search Terms Module
-if active_tab == "Related Search Terms":
-    if MODE == "Search Term":
-        analytics.write("Other search terms in the same cluster as this search term.")
-    else:
-        analytics.write("Search terms in this cluster.")
-
-    cluster_data = get_data(PARAMS["cluster_query"][MODE].format(**filter))
-    cluster_data = cluster_data[["SEARCH_TERM", "SEARCHES", "SESSIONS", "CLICKS", "CTR"]]
+# Warm the terms likely to be opened next while the analyst reads this one
+st.session_state["speculation"] = speculate(popular, term, filter, active_tab)
 
-    if len(cluster_data.index) != 0:
-        analytics.write(
-            cluster_data.to_html(index=False, escape=False, justify="left"),
-            unsafe_allow_html=True,
-        )
-    else:
-        if MODE == "Search Term":
-            analytics.write("_Search term is not part of a cluster._")
-        else:
-            analytics.write("No search terms in this cluster for the selected filters.")
-
-    analytics.markdown("""---""")
-    with analytics.expander("Snowflake Queries", expanded=False):
-        st.write("Analytics Overview:")
-        st.code(PARAMS["analytics_query"][MODE].format(**filter), language="sql")
-        st.write("Details Query:")
-        st.code(PARAMS["cluster_query"][MODE].format(**filter), language="sql")
-
-# Most Popular Results Module
-elif active_tab == "Most Popular Results":
-    analytics.write(f"The most clicked results for this {MODE.lower()}, sorted by popularity.")
-
-    results_data = get_data(PARAMS["results_query"][MODE].format(**filter))
-
-    response = get_results(term)
-    km_modules = [m for m in response["modules"] if m["source"] == "KNOWLEDGE_MANAGER"]
-    results = [m["results"] for m in km_modules]
-    all_results = flatten(results)
-    all_entities = [r["data"] for r in all_results if "data" in r]
-
-    id_name_dict = {}
-    for d in all_entities:
-        if "uid" in d and "name" in d:
-            id_name_dict[d["uid"]] = d["name"]
-
-    results_data["NAME"] = results_data["ENTITY_ID"].apply(lambda x: id_name_dict.get(str(x), ""))
-    results_data["ENTITY_ID"] = results_data["ENTITY_ID"].apply(
-        lambda x: make_clickable(
-            x, f"https://www.yext.com/s/{BUSINESS_ID}/entity/edit3?entityIds={x}"
-        )
-    )
-    results_data = results_data[["ENTITY_ID", "NAME", "SEARCHES", "SESSIONS", "CLICKS", "CTR"]]
-
-    if len(results_data.index) != 0:
-        analytics.write(
-            results_data.to_html(index=False, escape=False, justify="left"),
-            unsafe_allow_html=True,
-        )
-    else:
-        analytics.write(
-            f"_No entities have been clicked for this {MODE.lower()} with the selected filters._"
-        )
-
-    analytics.markdown("""---""")
-    with analytics.expander("Snowflake Queries", expanded=False):
-        st.write("Analytics Overview:")
-        st.code(PARAMS["analytics_query"][MODE].format(**filter), language="sql")
-        st.write("Details Query:")
-        st.code(PARAMS["results_query"][MODE].format(**filter), language="sql")
-
-# Most Popular Vertical Module
-elif active_tab == "Most Popular Verticals":
-    analytics.write(f"The most clicked verticals for this {MODE.lower()}, sorted by popularity.")
-
-    vertical_data = get_data(PARAMS["vertical_query"][MODE].format(**filter))
-
-    if len(vertical_data.index) != 0:
-        analytics.write(
-            vertical_data.to_html(index=False, escape=False, justify="left"),
-            unsafe_allow_html=True,
-        )
-    else:
-        analytics.write(
-            f"_No verticals clicked for this {MODE.lower()} with the selected filters._"
-        )
-
-    analytics.markdown("""---""")
-    with analytics.expander("Snowflake Queries", expanded=False):
-        st.write("Analytics Overview:")
-        st.code(PARAMS["analytics_query"][MODE].format(**filter), language="sql")
-        st.write("Details Query:")
-        st.code(PARAMS["vertical_query"][MODE].format(**filter), language="sql")
-
-# Integration Source Module
-elif active_tab == "Integration Source":
-    analytics.write("Search volume and engagement by custom integration source.")
-
-    source_data = get_data(PARAMS["source_query"][MODE].format(**filter))
-
-    if len(source_data.index) != 0:
-        analytics.write(
-            source_data.to_html(index=False, escape=False, justify="left"),
-            unsafe_allow_html=True,
-        )
-    else:
-        analytics.write(
-            f"_No searches on any integration sources for this {MODE.lower()} with the selected"
-            " filters._"
-        )
-
-    analytics.markdown("""---""")
-    with analytics.expander("Snowflake Queries", expanded=False):
-        st.write("Analytics Overview:")
-        st.code(PARAMS["analytics_query"][MODE].format(**filter), language="sql")
-        st.write("Details Query:")
-        st.code(PARAMS["source_query"][MODE].format(**filter), language="sql")
-
-# Search Log Module
-elif active_tab == "Search Logs":
-    analytics.write(f"A log of the most recent searches for this {MODE.lower()}.")
-
-    log_data = get_data(PARAMS["logs_query"][MODE].format(**filter))
-
-    log_data["QUERY_ID"] = log_data["QUERY_ID"].apply(
-        lambda x: make_clickable(
-            x,
-            f"https://www.yext.com/s/{BUSINESS_ID}/answers/experiences/{EXPERIENCE_KEY}/searchQueryLogDetails/{x}",
-        )
-    )
-
-    if len(log_data.index) != 0:
-        analytics.write(
-            log_data.to_html(index=False, escape=False, justify="left"), unsafe_allow_html=True
-        )
-    else:
-        analytics.write(f"_No recent searches this {MODE.lower()} with the selected filters._")
-
-    analytics.markdown("""---""")
-    with analytics.expander("Snowflake Queries", expanded=False):
-        st.write("Analytics Overview:")
-        st.code(PARAMS["analytics_query"][MODE].format(**filter), language="sql")
-        st.write("Details Query:")
-        st.code(PARAMS["logs_query"][MODE].format(**filter), language="sql")
-else:
-    st.error("Something has gone terribly wrong.")
-
-test_search.write("#### **Test Search**")
-test_search_term = test_search.text_input("", f"{term}")
-test_search.markdown("""---""")
-
-# Get Results for the Selected Search Term
-if test_search_term:
-    response = get_results(test_search_term)
-    km_modules = [m for m in response["modules"] if m["source"] == "KNOWLEDGE_MANAGER"]
-    verticals = [m["verticalConfigId"] for m in km_modules]
-    results = [m["results"] for m in km_modules]
-    results_dict = dict(zip(verticals, results))
-    all_results = flatten(results)
-    all_entities = [r["data"] for r in all_results if "data" in r]
-
-    for vertical in results_dict:
-        test_search.warning(f"**{vertical}**")
-        count = 0
-        for result in results_dict[vertical]:
-            if count > 4:
-                break
-            test_search.info(get_result_card(result))
-            count += 1
+# Cache occupancy and warehouse queue depth, for sizing replicas
+st.sidebar.markdown("""---""")
+st.sidebar.caption(format_occupancy(CACHE.occupancy()))
+st.sidebar.caption(format_queue(SCHEDULER.stats()))
@@ -0,0 +1,89 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+class EntityIndex:
+    # Entity id -> name index in a SQLite file, shared by every worker process that points at the
+    # same path, and kept per account (e.g. a hash of the API key) since ids are only unique within
+    # one. Names are refreshed incrementally: only ids never looked up, or looked up more than `ttl`
+    # seconds ago, are fetched again. Ids the API didn't return are kept for `miss_ttl` seconds, so
+    # deleted entities aren't asked for on every page but a lookup with the wrong key soon expires.
+
+    def __init__(self, path, ttl=24 * 3600, miss_ttl=600):
+        self.path = path
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self._local = threading.local()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._connect().execute(
+            """
+            create table if not exists entity_names (
+                account text not null,
+                uid text not null,
+                name text,
+                fetched real not null,
+                primary key (account, uid)
+            )
+            """
+        )
+
+    def _connect(self):
+        # sqlite3 connections can't be shared between threads, so keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("pragma journal_mode=wal")
+            self._local.conn = conn
+        return conn
+
+    def get(self, account, uids):
+        # Names indexed for `uids` as {uid: (name, fetched)}, skipping ids not indexed yet. The name
+        # is None for ids the API didn't return.
+        uids = list(dict.fromkeys(str(u) for u in uids))
+        conn = self._connect()
+        found = {}
+        # SQLite allows 999 variables per statement in older builds
+        for i in range(0, len(uids), 900):
+            chunk = uids[i : i + 900]
+            marks = ",".join("?" * len(chunk))
+            rows = conn.execute(
+                "select uid, name, fetched from entity_names"
+                f" where account = ? and uid in ({marks})",
+                [account, *chunk],
+            )
+            found.update((uid, (name, fetched)) for uid, name, fetched in rows)
+        return found
+
+    def stale(self, account, uids):
+        # Those of `uids` to fetch: never indexed, or indexed longer than ttl (or miss_ttl) ago
+        found = self.get(account, uids)
+        now = time.time()
+        stale = []
+        for u in dict.fromkeys(str(u) for u in uids):
+            name, fetched = found.get(u, (None, 0))
+            if now - fetched > (self.ttl if name is not None else self.miss_ttl):
+                stale.append(u)
+        return stale
+
+    def update(self, account, uids, names):
+        # Record a fetch of `uids` that returned `names` ({uid: name}); the rest have no entity
+        now = time.time()
+        conn = self._connect()
+        conn.execute("begin immediate")
+        try:
+            conn.executemany(
+                "insert or replace into entity_names values (?, ?, ?, ?)",
+                [(account, str(u), names.get(str(u)), now) for u in uids],
+            )
+            conn.execute("commit")
+        except BaseException:
+            conn.execute("rollback")
+            raise
+
+    def names(self, account, uids):
+        # {uid: name} for the ids among `uids` indexed with a name
+        found = self.get(account, uids)
+        return {uid: name for uid, (name, _) in found.items() if name is not None}
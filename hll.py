@@ -0,0 +1,47 @@
+import json
+import math
+from functools import lru_cache
+
+import numpy as np
+
+
+# HyperLogLog sketches in Snowflake's HLL_EXPORT format, e.g.
+#   {"version": 4, "precision": 12, "sparse": {"indices": [...], "maxLzCounts": [...]}}
+# or {"version": 4, "precision": 12, "dense": [...]}, merged and estimated locally. A sketch is its
+# registers (the max leading zero count + 1 of the hashes in each bucket) as a uint8 array.
+
+
+@lru_cache(maxsize=8192)
+def loads(text):
+    # Registers of an exported sketch. Parsed sketches are cached (and so read-only), since the
+    # same rows are merged again for every filter and date window.
+    sketch = json.loads(text)
+    registers = np.zeros(2 ** sketch["precision"], dtype=np.uint8)
+    if "dense" in sketch:
+        registers[:] = sketch["dense"]
+    else:
+        registers[sketch["sparse"]["indices"]] = sketch["sparse"]["maxLzCounts"]
+    registers.flags.writeable = False
+    return registers
+
+
+def merge(sketches):
+    # Registers of the union of the sketches (text or registers) of the same precision
+    merged = None
+    for sketch in sketches:
+        registers = loads(sketch) if isinstance(sketch, str) else sketch
+        merged = registers.copy() if merged is None else np.maximum(merged, registers, out=merged)
+    return merged
+
+
+def estimate(registers):
+    # Distinct values counted by a sketch, with linear counting while many registers are empty
+    if registers is None:
+        return 0
+    m = len(registers)
+    alpha = 0.7213 / (1 + 1.079 / m)
+    e = alpha * m * m / np.ldexp(1.0, -registers.astype(np.int32)).sum()
+    zeros = m - np.count_nonzero(registers)
+    if e <= 2.5 * m and zeros:
+        e = m * math.log(m / zeros)
+    return int(round(e))
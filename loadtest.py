@@ -0,0 +1,304 @@
+# Load test for demo.py: drives simulated analyst sessions through the page with Streamlit's app
+# testing API, against fake Snowflake and Yext clients backed by the benchmark's synthetic DuckDB
+# data (needs `pip install duckdb` and Streamlit 1.40).
+#
+#   python loadtest.py --sessions 50 --actions 20 --latency 1.5
+
+import argparse
+import json
+import os
+import random
+import resource
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from unittest import mock
+from unittest.mock import MagicMock
+from urllib import parse
+
+import numpy as np
+import streamlit as st
+from streamlit import config
+from streamlit import logger as streamlit_logger
+from streamlit.runtime import Runtime
+from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+from streamlit.runtime.media_file_manager import MediaFileManager
+from streamlit.runtime.fragment import MemoryFragmentStorage
+from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+from streamlit.runtime.pages_manager import PagesManager
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+from streamlit.runtime.scriptrunner_utils.script_requests import RerunData
+from streamlit.runtime.secrets import Secrets
+from streamlit.testing.v1 import AppTest
+from streamlit.testing.v1.element_tree import parse_tree_from_messages
+from streamlit.testing.v1.local_script_runner import LocalScriptRunner, require_widgets_deltas
+
+import benchmark
+import utils
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "demo.py")
+SECRETS = {
+    "sample": {
+        "business_id": benchmark.BUSINESS_ID,
+        "exp_key": benchmark.EXPERIENCE_KEY,
+        "api_key": "load-test",
+    },
+    "snowflake": {"account": "load-test", "user": "load-test", "pass": "load-test"},
+}
+
+
+class FakeCursor:
+    # Snowflake cursor that runs queries on DuckDB after a simulated warehouse round trip
+    query_ids = count()
+
+    def __init__(self, conn, latency):
+        self._conn = conn.cursor()
+        self._latency = latency
+        self.sfqid = None
+        self.description = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    def execute(self, query, params=None):
+        time.sleep(random.uniform(0.5, 1.5) * self._latency)
+        self.sfqid = f"load-test-{next(self.query_ids)}"
+        self._conn.execute(benchmark.duckdb_sql(query), params)
+        self.description = [(c[0].upper(), *c[1:]) for c in self._conn.description]
+        return self
+
+    def fetch_arrow_all(self):
+        # Like the connector, no table when there are no rows
+        table = self._conn.fetch_arrow_table()
+        if table.num_rows == 0:
+            return None
+        return benchmark.snowflake_types(table)
+
+    def fetchone(self):
+        return self._conn.fetchone()
+
+
+class FakeConnection:
+    def __init__(self, conn, latency):
+        self._conn = conn
+        self._latency = latency
+        self._closed = False
+
+    def cursor(self):
+        return FakeCursor(self._conn, self._latency)
+
+    def is_closed(self):
+        return self._closed
+
+    def close(self):
+        self._closed = True
+
+
+class FakeYextClient:
+    # Yext client answering universal searches with made up entities for the term, and entity
+    # lookups with made up names
+    latency = 0.5
+
+    def __init__(self, api_key, env=None):
+        pass
+
+    def search_answers_universal(self, query, experience_key):
+        time.sleep(random.uniform(0.5, 1.5) * self.latency)
+        rng = random.Random(query)
+        modules = []
+        for vertical in ["faqs", "products"]:
+            results = []
+            for _ in range(5):
+                uid = rng.randrange(1000)
+                data = {"id": f"entity-{uid}", "uid": str(uid), "name": f"{vertical} {uid}"}
+                results.append({"data": data})
+            modules.append(
+                {"source": "KNOWLEDGE_MANAGER", "verticalConfigId": vertical, "results": results}
+            )
+        return mock.Mock(raw_response={"response": {"modules": modules}})
+
+    def get_all_entities(self, params):
+        time.sleep(random.uniform(0.5, 1.5) * self.latency)
+        uids = [f["uid"]["$eq"] for f in json.loads(params["filter"])["$or"]]
+        return [{"meta": {"uid": uid}, "name": f"Entity {uid}"} for uid in uids]
+
+
+class SessionRunner(LocalScriptRunner):
+    # Runs the script once for a SessionTest, with its compiled script and fragments. Given a
+    # fragment, it reruns just that, as the browser asks for when a widget inside one changes.
+
+    def __init__(self, test):
+        super().__init__(test._script_path, test.session_state, test.pages_manager)
+        self._script_cache = SessionTest.script_cache
+        self._fragment_storage = test.fragment_storage
+
+    def run(self, widget_state, query_params, timeout, fragment_id=None):
+        self.request_rerun(
+            RerunData(
+                widget_states=widget_state,
+                query_string=parse.urlencode(query_params, doseq=True),
+                fragment_id_queue=[fragment_id] if fragment_id else [],
+                is_fragment_scoped_rerun=fragment_id is not None,
+            )
+        )
+        self.start()
+        require_widgets_deltas(self, timeout)
+        return self.forward_msgs()
+
+
+class SessionTest(AppTest):
+    # AppTest swaps the runtime and secrets in and out around every run, compiles the script each
+    # time and reruns the whole script for every change, fragments included. These run against the
+    # ones set up by `install_runtime` instead, share the compiled script, and rerun only the
+    # fragment a changed widget is in when `fragment` is set, like the browser does.
+    script_cache = ScriptCache()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pages_manager = PagesManager(self._script_path, setup_watcher=False)
+        self.fragment_storage = MemoryFragmentStorage()
+        self.fragment = None
+        self.errors = 0
+        self._messages = []
+
+    def fragment_of(self, key):
+        # ID of the fragment the widget with this key was drawn in, if any
+        for msg in self._messages:
+            element = msg.delta.new_element
+            widget = getattr(element, element.WhichOneof("type") or "", None)
+            if widget is not None and getattr(widget, "id", "").endswith(f"-{key}"):
+                return msg.delta.fragment_id or None
+
+    def _run(self, widget_state=None, timeout=None):
+        fragment_id, self.fragment = self.fragment, None
+        runner = SessionRunner(self)
+        messages = runner.run(
+            widget_state, self.query_params, timeout or self.default_timeout, fragment_id
+        )
+        # The query string the script left is sent with the shutdown event, after it stops
+        runner.join()
+        self.query_params = parse.parse_qs(runner.event_data[-1]["client_state"].query_string)
+        self.errors = len(parse_tree_from_messages(messages).exception)
+
+        # A fragment's elements replace its earlier ones in the page from the last full run
+        self._messages = messages if fragment_id is None else self._messages + messages
+        self._tree = parse_tree_from_messages(self._messages)
+        self._tree._runner = self
+        return self
+
+
+def install_runtime():
+    runtime = MagicMock(spec=Runtime)
+    runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    runtime.cache_storage_manager = MemoryCacheStorageManager()
+    Runtime._instance = runtime
+
+    # Widgets record their format functions for the test API only in app test mode
+    config.set_option("global.appTest", True)
+    secrets = Secrets()
+    secrets._secrets = SECRETS
+    st.secrets = secrets
+    SessionTest.script_cache.get_bytecode(SCRIPT)
+
+
+def simulate(session, actions, timeout):
+    # One analyst: open the page, then change term, tab, filters or test search at random
+    rng = random.Random(session)
+    at = SessionTest(SCRIPT, default_timeout=timeout)
+
+    timings, errors = [], 0
+    for action in range(actions + 1):
+        if action:
+            change = rng.choice(["term", "tab", "date", "traffic", "label", "search"])
+            if change == "term":
+                at.selectbox(key="s").select(rng.choice(at.selectbox(key="s").options))
+            elif change == "tab":
+                at.radio(key="tabs").set_value(rng.choice(at.radio(key="tabs").options))
+                at.fragment = at.fragment_of("tabs")
+            elif change == "date":
+                at.selectbox(key="d").select(rng.choice(utils.DATE_OPTIONS))
+            elif change == "traffic":
+                at.selectbox(key="t").select(rng.choice(utils.TRAFFIC_OPTIONS))
+            elif change == "label":
+                at.selectbox(key="l").select(rng.choice(utils.LABEL_OPTIONS))
+            else:
+                search = at.text_input(key="test_search")
+                search.input(rng.choice(at.selectbox(key="s").options))
+                at.fragment = at.fragment_of("test_search")
+
+        start = time.perf_counter()
+        at.run()
+        timings.append(time.perf_counter() - start)
+        errors += at.errors
+    return timings, errors
+
+
+def cache_hit_rate(path):
+    with open(path) as f:
+        statuses = [json.loads(line).get("status") for line in f]
+    statuses = [s for s in statuses if s]
+    return sum(s.endswith("hit") for s in statuses) / len(statuses), len(statuses)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test demo.py with simulated sessions")
+    parser.add_argument("--sessions", type=int, default=10, help="concurrent simulated sessions")
+    parser.add_argument("--actions", type=int, default=10, help="interactions per session")
+    parser.add_argument("--latency", type=float, default=1.0, help="mean Snowflake latency (s)")
+    parser.add_argument("--yext-latency", type=float, default=0.5, help="mean Yext latency (s)")
+    parser.add_argument("--searches", type=int, default=10**5, help="rows of synthetic data")
+    parser.add_argument("--db", help="DuckDB file with benchmark data to reuse")
+    parser.add_argument("--timeout", type=float, default=120, help="max seconds per rerun")
+    parser.add_argument("--rollups", action="store_true", help="read the rollup tables")
+    args = parser.parse_args()
+
+    warehouse = benchmark.connect(args.db, args.searches)
+    FakeYextClient.latency = args.yext_latency
+    utils.ROLLUP_QUERIES = args.rollups
+
+    # Keep the load test's cache and metrics out of the app's own
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    utils.CACHE_PATH = os.path.join(workdir, "cache.sqlite")
+    utils.METRICS_PATH = os.path.join(workdir, "metrics.jsonl")
+    utils.ENTITY_INDEX_PATH = os.path.join(workdir, "entities.sqlite")
+
+    def connect(**kwargs):
+        return FakeConnection(warehouse, args.latency)
+
+    # Streamlit logs deprecation and label warnings on every run
+    streamlit_logger.set_log_level("error")
+    install_runtime()
+    start = time.time()
+    with mock.patch("snowflake.connector.connect", connect), mock.patch(
+        "yext.YextClient", FakeYextClient
+    ):
+        with ThreadPoolExecutor(max_workers=args.sessions) as pool:
+            runs = [
+                pool.submit(simulate, session, args.actions, args.timeout)
+                for session in range(args.sessions)
+            ]
+            results = [run.result() for run in runs]
+    elapsed = time.time() - start
+
+    first = [timings[0] for timings, _ in results]
+    reruns = [t for timings, _ in results for t in timings[1:]]
+    errors = sum(e for _, e in results)
+    hit_rate, calls = cache_hit_rate(utils.METRICS_PATH)
+    # Peak resident memory of the whole process, the synthetic warehouse included
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    print(f"{args.sessions} sessions x {args.actions} actions in {elapsed:.1f}s, {errors} errors")
+    for name, values in [("first load", first), ("rerun", reruns)]:
+        print(
+            f"{name:<12} p50 {np.percentile(values, 50):6.2f}s  p95 {np.percentile(values, 95):6.2f}s"
+            f"  p99 {np.percentile(values, 99):6.2f}s  max {max(values):6.2f}s"
+        )
+    print(f"cache hit rate {hit_rate:.0%} of {calls} get_data calls")
+    print(f"peak memory {peak_mb:.0f} MB")
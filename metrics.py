@@ -0,0 +1,113 @@
+import json
+import os
+import threading
+import time
+
+
+class QueryMetrics:
+    # Per-query timing and cost stats. The latest stats for each key are kept in memory for display,
+    # and every record is appended as a JSON line to `path` for later analysis. Once the file passes
+    # `max_bytes` it's moved to `path`.1 (replacing the last one) and a new one started.
+
+    def __init__(self, path, max_bytes=64 * 1024**2):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._latest = {}
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def record(self, key, **stats):
+        entry = {"time": time.time(), "key": key, **stats}
+        with self._lock:
+            self._latest.setdefault(key, {}).update(entry)
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry, default=str) + "\n")
+                full = f.tell() > self.max_bytes
+            if full:
+                os.replace(self.path, self.path + ".1")
+
+    def latest(self, key):
+        with self._lock:
+            return dict(self._latest.get(key, {}))
+
+
+class ScanLookups:
+    # Bytes scanned by finished queries, looked up in batches. Query IDs queue up, and every
+    # `period` seconds a background thread calls `lookup(ids)` ({query ID: bytes scanned}) for all
+    # of them at once and records the results. IDs not in the query history yet are tried again,
+    # up to `attempts` times; stats are best effort.
+
+    def __init__(self, lookup, metrics, period=60, attempts=3):
+        self.lookup = lookup
+        self.metrics = metrics
+        self.period = period
+        self.attempts = attempts
+        self._lock = threading.Lock()
+        self._pending = {}
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def add(self, key, query_id):
+        with self._lock:
+            self._pending[query_id] = (key, 0)
+
+    def _run(self):
+        while True:
+            time.sleep(self.period)
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                continue
+            try:
+                scanned = self.lookup(list(pending))
+            except Exception:
+                scanned = {}
+            retry = {}
+            for query_id, (key, attempt) in pending.items():
+                if query_id in scanned:
+                    self.metrics.record(key, bytes_scanned=scanned[query_id])
+                elif attempt + 1 < self.attempts:
+                    retry[query_id] = (key, attempt + 1)
+            with self._lock:
+                self._pending = {**retry, **self._pending}
+
+
+def _size(n):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if n < 1024 or unit == "GB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+
+
+def format_stats(stats):
+    # One-line summary of a query's latest stats, e.g. for the "Snowflake Queries" expanders
+    parts = []
+    if "seconds" in stats:
+        parts.append(f"{stats['seconds']:.2f}s ({stats['status']})")
+    if "rows" in stats:
+        parts.append(f"{stats['rows']} rows, {_size(stats['bytes'])}")
+    if "query_id" in stats:
+        parts.append(f"query ID {stats['query_id']} ran in {stats['warehouse_seconds']:.2f}s")
+    if stats.get("queued_seconds", 0) >= 0.01:
+        parts.append(f"queued {stats['queued_seconds']:.2f}s")
+    if "bytes_scanned" in stats:
+        parts.append(f"{_size(stats['bytes_scanned'])} scanned")
+    return " · ".join(parts)
+
+
+def format_occupancy(stats):
+    # One-line summary of DiskCache.occupancy(), e.g. for the sidebar
+    return (
+        f"Cache: {stats['memory_entries']} results in memory"
+        f" ({_size(stats['memory_bytes'])} of {_size(stats['memory_max_bytes'])}),"
+        f" {stats['disk_entries']} on disk"
+        f" ({_size(stats['disk_bytes'])} of {_size(stats['disk_max_bytes'])})"
+    )
+
+
+def format_queue(stats):
+    # One-line summary of QueryScheduler.stats(), e.g. for the sidebar
+    return (
+        f"Warehouse: {stats['running']} of {stats['limit']} queries running,"
+        f" {stats['waiting_visible']} visible, {stats['waiting_background']} background and"
+        f" {stats['waiting_bulk']} bulk waiting, {stats['cancelled']} dropped"
+    )
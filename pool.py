@@ -0,0 +1,68 @@
+import queue
+import threading
+import time
+
+# Snowflake error codes for expired or invalidated sessions and tokens
+EXPIRED_SESSION_ERRORS = {390111, 390112, 390114}
+
+
+class ConnectionPool:
+    # Bounded pool of connections made by `connect`, so concurrent sessions each borrow one rather
+    # than queueing on a single shared connection. Waiting for a free connection gives up after
+    # `timeout` seconds; connections idle for longer than `check_after` seconds are pinged first.
+
+    def __init__(self, connect, size=8, timeout=30, check_after=300):
+        self.size = size
+        self.timeout = timeout
+        self.check_after = check_after
+        self._connect = connect
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _checkout(self):
+        while True:
+            try:
+                conn, returned = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            if self._healthy(conn, returned):
+                return conn
+            self._close(conn)
+
+    def _healthy(self, conn, returned):
+        if conn.is_closed():
+            return False
+        if time.time() - returned < self.check_after:
+            return True
+        try:
+            with conn.cursor() as curs:
+                curs.execute("select 1")
+            return True
+        except Exception:
+            return False
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def run(self, func):
+        # Call func(conn) with a borrowed connection, reconnecting once if its session has expired
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError(f"No Snowflake connection free after {self.timeout}s")
+        try:
+            for attempt in range(2):
+                conn = self._checkout() if attempt == 0 else self._connect()
+                try:
+                    result = func(conn)
+                except Exception as e:
+                    if attempt == 0 and getattr(e, "errno", None) in EXPIRED_SESSION_ERRORS:
+                        self._close(conn)
+                        continue
+                    self._idle.put((conn, time.time()))
+                    raise
+                self._idle.put((conn, time.time()))
+                return result
+        finally:
+            self._slots.release()
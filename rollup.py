@@ -0,0 +1,162 @@
+# Builds and maintains the daily rollup tables read by the ROLLUP_PARAMS queries (see utils). Each
+# run rebuilds the last few complete days, to pick up late events, and any days since the table's
+# watermark, then moves the watermark to yesterday. The first run builds ROLLUP_DAYS of history.
+#
+#   python rollup.py              # e.g. hourly, from cron
+#   python rollup.py --days 30    # after a backfill of the raw tables
+
+import argparse
+import time
+
+from utils import *
+
+# One row per business, experience, search term, day, traffic source, configuration label and
+# dimension value. Counts are per search so they add up across rows; sessions are kept as HLL
+# sketches to combine. Clusters are joined in when reading, so re-clustering needs no rebuild.
+BUILD_QUERIES = {
+    "search_term_daily": """
+select
+    searches.business_id,
+    searches.experience_key,
+    searches.tokenizer_normalized_query as search_term,
+    date(searches.timestamp) as date,
+    user_data.traffic_source,
+    searches.version_label,
+    user_data.query_source,
+    count(distinct searches.query_id) as searches,
+    count(case when user_event_types.is_click_event then 1 end) as clicks,
+    count(distinct case when user_event_types.is_click_event then searches.query_id end) as clicked_searches,
+    count(distinct case when searches.has_kg_results then searches.query_id end) as kg_searches,
+    hll_accumulate(user_data.session_id) as sessions_hll
+from
+    searches
+    join user_data on searches.id = user_data.search_id
+    left join user_events on searches.id = user_events.search_id
+    left join user_event_types on user_events.user_event_type_id = user_event_types.id
+where
+    date(searches.timestamp) > dateadd('day', {d}, current_date())
+    and date(searches.timestamp) < current_date()
+group by 1, 2, 3, 4, 5, 6, 7
+""",
+    "search_term_entity_daily": """
+select
+    searches.business_id,
+    searches.experience_key,
+    searches.tokenizer_normalized_query as search_term,
+    date(searches.timestamp) as date,
+    user_data.traffic_source,
+    searches.version_label,
+    results.entity_id,
+    count(distinct searches.query_id) as searches,
+    count(case when user_event_types.is_click_event then 1 end) as clicks,
+    count(distinct case when user_event_types.is_click_event then searches.query_id end) as clicked_searches,
+    hll_accumulate(user_data.session_id) as sessions_hll
+from
+    searches
+    join user_data on searches.id = user_data.search_id
+    left join vertical_searchers on searches.id = vertical_searchers.search_id
+    left join results on vertical_searchers.id = results.vertical_searcher_id
+    left join user_events on searches.id = user_events.search_id and vertical_searchers.id = user_events.vertical_searcher_id and results.entity_id = user_events.entity_id
+    left join user_event_types on user_events.user_event_type_id = user_event_types.id
+where
+    date(searches.timestamp) > dateadd('day', {d}, current_date())
+    and date(searches.timestamp) < current_date()
+group by 1, 2, 3, 4, 5, 6, 7
+""",
+    "search_term_vertical_daily": """
+select
+    searches.business_id,
+    searches.experience_key,
+    searches.tokenizer_normalized_query as search_term,
+    date(searches.timestamp) as date,
+    user_data.traffic_source,
+    searches.version_label,
+    vertical_searchers.vertical_id,
+    count(distinct searches.query_id) as searches,
+    count(case when user_event_types.is_click_event then 1 end) as clicks,
+    count(distinct case when user_event_types.is_click_event then searches.query_id end) as clicked_searches,
+    hll_accumulate(user_data.session_id) as sessions_hll
+from
+    searches
+    join user_data on searches.id = user_data.search_id
+    left join vertical_searchers on searches.id = vertical_searchers.search_id
+    left join user_events on searches.id = user_events.search_id and vertical_searchers.id = user_events.vertical_searcher_id
+    left join user_event_types on user_events.user_event_type_id = user_event_types.id
+where
+    date(searches.timestamp) > dateadd('day', {d}, current_date())
+    and date(searches.timestamp) < current_date()
+group by 1, 2, 3, 4, 5, 6, 7
+""",
+}
+
+# Last complete day in each rollup table; the reads go to the raw tables for the days after it
+CREATE_WATERMARKS = """
+create table if not exists search_rollup_watermarks (
+    table_name varchar,
+    through_date date,
+    built_at timestamp
+)
+"""
+
+WATERMARK_QUERY = """
+select
+    (select max(through_date) from search_rollup_watermarks where table_name = '{table}'),
+    current_date()
+"""
+
+
+def connect(warehouse):
+    # Imported here so the benchmark can build rollups in DuckDB without the connector
+    import streamlit as st
+    from snowflake import connector
+
+    return connector.connect(
+        authenticator="https://yext.okta.com",
+        account=st.secrets["snowflake"]["account"],
+        user=st.secrets["snowflake"]["user"],
+        warehouse=warehouse,
+        password=st.secrets["snowflake"]["pass"],
+    )
+
+
+def build(conn, table, days):
+    # Rebuild the last `days` complete days of `table` (and any since its watermark, or all of
+    # ROLLUP_DAYS if it has none) in one transaction, so reads never see a partial rebuild.
+    # Returns the number of days rebuilt.
+    query = BUILD_QUERIES[table]
+    with conn.cursor() as curs:
+        curs.execute(CREATE_WATERMARKS)
+        curs.execute(f"create table if not exists {table} as {query.format(d=0)}")
+        through, today = curs.execute(WATERMARK_QUERY.format(table=table)).fetchone()
+        d = -ROLLUP_DAYS if through is None else min(-days - 1, (through - today).days)
+        d = max(d, -ROLLUP_DAYS)
+
+        curs.execute("begin")
+        curs.execute(
+            f"delete from {table} where date > dateadd('day', {d}, current_date())"
+            f" or date <= dateadd('day', {-ROLLUP_DAYS}, current_date())"
+        )
+        curs.execute(f"insert into {table} {query.format(d=d)}")
+        curs.execute(f"delete from search_rollup_watermarks where table_name = '{table}'")
+        curs.execute(
+            "insert into search_rollup_watermarks"
+            f" select '{table}', dateadd('day', -1, current_date()), current_timestamp"
+        )
+        curs.execute("commit")
+    return -d - 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build and maintain the daily rollup tables")
+    parser.add_argument("--days", type=int, default=3, help="complete days to rebuild")
+    parser.add_argument("--warehouse", default="HUMAN_WH", help="Snowflake warehouse to build on")
+    parser.add_argument(
+        "--table", action="append", choices=list(BUILD_QUERIES), help="only this table"
+    )
+    args = parser.parse_args()
+
+    conn = connect(args.warehouse)
+    for table in args.table or BUILD_QUERIES:
+        start = time.time()
+        days = build(conn, table, args.days)
+        print(f"Rebuilt {days} days of {table} in {time.time() - start:.1f}s")
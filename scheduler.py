@@ -0,0 +1,133 @@
+import contextvars
+import itertools
+import threading
+import time
+from collections import Counter
+
+# Priority classes, most urgent first: queries the page is waiting to show, prefetches and
+# background refreshes, then bulk work like stats lookups and exports
+VISIBLE, BACKGROUND, BULK = 0, 1, 2
+PRIORITY_NAMES = {VISIBLE: "visible", BACKGROUND: "background", BULK: "bulk"}
+
+# (priority, run) that queries started from the current thread are scheduled with
+_context = contextvars.ContextVar("query_context", default=(VISIBLE, None))
+
+
+class Cancelled(Exception):
+    # A query dropped before it started, because the run that asked for it was superseded
+    pass
+
+
+class Run:
+    # One script run of a session. Queries it queued are dropped once a newer run supersedes it.
+
+    def __init__(self, session):
+        self.session = session
+        self.superseded = False
+
+
+def enter(run, priority=VISIBLE):
+    # Schedule queries started from this thread at `priority` for `run`
+    _context.set((priority, run))
+
+
+def bind(func, priority, run=None):
+    # func, with the queries it starts scheduled at `priority` for `run`, e.g. to run on a worker
+    def bound(*args):
+        token = _context.set((priority, run))
+        try:
+            return func(*args)
+        finally:
+            _context.reset(token)
+
+    return bound
+
+
+def current_priority():
+    return _context.get()[0]
+
+
+def superseded():
+    run = _context.get()[1]
+    return run is not None and run.superseded
+
+
+class _Entry:
+    def __init__(self, priority, seq, key, run):
+        self.priority = priority
+        self.seq = seq
+        self.key = key
+        self.run = run
+        self.session = run.session if run is not None else None
+
+
+class QueryScheduler:
+    # Admits at most `limit` queries to the warehouse at once. Waiting queries go in priority order
+    # and, within a class, the session with the fewest queries running goes first (then first
+    # come, first served). Queries of superseded runs are never admitted: dropped while they wait,
+    # or straight away when asked for after. Those already running finish, since other sessions
+    # may be sharing their results.
+
+    def __init__(self, limit=6, timeout=30):
+        self.limit = limit
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._waiting = []
+        self._running = Counter()
+        self._cancelled = 0
+
+    def _next(self):
+        return min(self._waiting, key=lambda e: (e.priority, self._running[e.session], e.seq))
+
+    def promote(self, key, priority):
+        # Raise waiting queries for `key` to `priority`, when a more urgent caller joins them
+        with self._cond:
+            for entry in self._waiting:
+                if entry.key == key and priority < entry.priority:
+                    entry.priority = priority
+                    self._cond.notify_all()
+
+    def supersede(self, run):
+        with self._cond:
+            run.superseded = True
+            self._cond.notify_all()
+
+    def run(self, func, key=None):
+        # Call func() once admitted, with the current thread's priority and run
+        priority, run = _context.get()
+        entry = _Entry(priority, next(self._seq), key, run)
+        deadline = time.time() + self.timeout
+        with self._cond:
+            self._waiting.append(entry)
+            try:
+                while True:
+                    if run is not None and run.superseded:
+                        self._cancelled += 1
+                        raise Cancelled()
+                    if sum(self._running.values()) < self.limit and self._next() is entry:
+                        break
+                    if not self._cond.wait(timeout=deadline - time.time()):
+                        raise TimeoutError(f"Query not admitted after {self.timeout}s")
+            finally:
+                self._waiting.remove(entry)
+                self._cond.notify_all()
+            self._running[entry.session] += 1
+
+        try:
+            return func()
+        finally:
+            with self._cond:
+                self._running[entry.session] -= 1
+                self._cond.notify_all()
+
+    def stats(self):
+        # Queue depth by priority class, for the metrics log
+        with self._cond:
+            waiting = Counter(e.priority for e in self._waiting)
+            return {
+                "running": sum(self._running.values()),
+                "limit": self.limit,
+                "cancelled": self._cancelled,
+                **{f"waiting_{name}": waiting[p] for p, name in PRIORITY_NAMES.items()},
+            }
@@ -0,0 +1,37 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Speculator:
+    # Runs speculative work on a few background threads of its own, so it only uses capacity the
+    # page's queries aren't. Work that would hit the warehouse first takes from a budget of
+    # `budget` queries per `period` seconds shared by every session, and is skipped once it's spent.
+
+    def __init__(self, workers=2, budget=30, period=60):
+        self.budget = budget
+        self.period = period
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        self._spent = deque()
+
+    def spend(self):
+        # Take one query from the budget, or False if none is left in this period
+        now = time.time()
+        with self._lock:
+            while self._spent and now - self._spent[0] > self.period:
+                self._spent.popleft()
+            if len(self._spent) >= self.budget:
+                return False
+            self._spent.append(now)
+            return True
+
+    def submit(self, func, *args):
+        return self._pool.submit(func, *args)
+
+
+def cancel(futures):
+    # Drop speculative work that hasn't started; work already running finishes and is still cached
+    for future in futures:
+        future.cancel()
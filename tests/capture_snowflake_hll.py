@@ -0,0 +1,45 @@
+# Captures HLL_EXPORT sketches and Snowflake's own HLL_ESTIMATE of them into
+# fixtures/snowflake_hll.json, for test_hll.py to check hll.py's reading of the export format against.
+# Each case is a run of distinct values split into two halves, exported separately, plus the
+# estimate of the whole.
+#
+#   python tests/capture_snowflake_hll.py --warehouse HUMAN_WH
+
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import rollup
+
+FIXTURE = os.path.join(os.path.dirname(__file__), "fixtures", "snowflake_hll.json")
+
+CASE_QUERY = """
+with values_ as (select seq8() as v from table(generator(rowcount => {n})))
+select
+    hll_export(hll_accumulate(case when v < {half} then v end)),
+    hll_export(hll_accumulate(case when v >= {half} then v end)),
+    hll_estimate(hll_accumulate(v))
+from values_
+"""
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Capture Snowflake HLL fixtures")
+    parser.add_argument("--warehouse", default="HUMAN_WH", help="Snowflake warehouse to run on")
+    args = parser.parse_args()
+
+    conn = rollup.connect(args.warehouse)
+    cases = []
+    with conn.cursor() as curs:
+        for n in [100, 1000, 10**4, 10**5, 10**6, 10**7]:
+            first, second, estimate = curs.execute(
+                CASE_QUERY.format(n=n, half=n // 2)
+            ).fetchone()
+            cases.append({"distinct": n, "sketches": [first, second], "estimate": estimate})
+            print(f"{n:>10} distinct: Snowflake estimates {estimate}")
+
+    os.makedirs(os.path.dirname(FIXTURE), exist_ok=True)
+    with open(FIXTURE, "w") as f:
+        json.dump(cases, f, indent=2)
@@ -1,4 +1,14 @@
-from regex import P
+import hashlib
+import re
+import textwrap
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+import hll
 
 
 def flatten(values):
@@ -15,6 +25,377 @@ def make_clickable(text, link):
     return f'<a target="_blank" href="{link}">{text}</a>'
 
 
+def make_links(values, link):
+    # make_clickable for a whole column, with each value put in place of the link's {}. Formatted
+    # and joined by Arrow, about twice as fast as applying make_clickable row by row.
+    prefix, suffix = link.split("{}")
+    text = pc.fill_null(pc.cast(pa.array(values, from_pandas=True), pa.string()), "")
+    links = pc.binary_join_element_wise(
+        '<a target="_blank" href="' + prefix, text, suffix + '">', text, "</a>", ""
+    )
+    return pd.Series(links.to_numpy(zero_copy_only=False), index=values.index, name=values.name)
+
+
+def fingerprint(data):
+    # Hash of a frame's columns, values and attrs, to key things derived from it
+    digest = hashlib.sha256(repr((list(data.columns), sorted(data.attrs.items()))).encode())
+    digest.update(pd.util.hash_pandas_object(data, index=False).values.tobytes())
+    return digest.hexdigest()
+
+
+def _after(data, d, column):
+    # Rows dated after a DATE_OPTIONS offset, same as `date > dateadd('day', d, current_date())`
+    start = pd.Timestamp.today().normalize() + pd.Timedelta(days=d)
+    return pd.to_datetime(data[column]).dt.normalize() > start
+
+
+def date_window(table, d, column="DATE"):
+    # Rows of an Arrow table dated after a DATE_OPTIONS offset
+    start = (pd.Timestamp.today().normalize() + pd.Timedelta(days=d)).date()
+    dates = pc.cast(table[column], pa.date32())
+    return table.filter(pc.greater(dates, pa.scalar(start, pa.date32())))
+
+
+def to_table(data):
+    return pa.Table.from_pandas(data, preserve_index=False)
+
+
+def to_frame(table, columns=None):
+    # pandas frame of an Arrow result, with only `columns` if given. Results stay Arrow tables in
+    # the cache and are only converted here, once they're cut down to what the page shows.
+    if columns is not None:
+        table = table.select(columns)
+    data = table.to_pandas()
+    metadata = table.schema.metadata or {}
+    if b"refreshed" in metadata:
+        data.attrs["refreshed"] = float(metadata[b"refreshed"])
+    return data
+
+
+def compact(table):
+    # Dictionary-encode repeated text columns (categoricals in pandas) and downcast integer columns
+    # to the smallest type that holds their values, so cached results take less memory
+    columns = []
+    for name, column in zip(table.column_names, table.columns):
+        if name in CATEGORY_COLUMNS and pa.types.is_string(column.type):
+            column = pc.dictionary_encode(column)
+        elif pa.types.is_integer(column.type) and column.null_count < len(column):
+            bounds = pc.min_max(column)
+            for smaller in [pa.int8(), pa.int16(), pa.int32()]:
+                info = np.iinfo(smaller.to_pandas_dtype())
+                if info.min <= bounds["min"].as_py() and bounds["max"].as_py() <= info.max:
+                    column = column.cast(smaller)
+                    break
+        columns.append(column)
+    # pandas metadata would describe the old types
+    metadata = {k: v for k, v in (table.schema.metadata or {}).items() if k != b"pandas"}
+    return pa.Table.from_arrays(columns, names=table.column_names, metadata=metadata or None)
+
+
+def mark_refreshed(table, created):
+    # Tag a stale result with when it was fetched, for to_frame to pass on
+    metadata = {**(table.schema.metadata or {}), b"refreshed": str(created).encode()}
+    return table.replace_schema_metadata(metadata)
+
+
+def date_column(key):
+    return "TIMESTAMP" if key == "logs_query" else "DATE"
+
+
+def merge_daily(key, data, update, d):
+    # Replace the days after offset `d` in cached daily results with freshly fetched ones
+    column = date_column(key)
+    merged = pd.concat(
+        [data[~_after(data, d, column)], update[_after(update, d, column)]], ignore_index=True
+    )
+    if key == "logs_query":
+        merged = merged.sort_values("TIMESTAMP", ascending=False)
+        merged = merged.groupby(["TRAFFIC_SOURCE", "VERSION_LABEL"], dropna=False).head(10)
+    return merged[_after(merged, WIDEST_DATE_OFFSET, column)].reset_index(drop=True)
+
+
+def round_half_up(values, digits=2):
+    # Snowflake's round() rounds halves away from zero, pandas' round() to even
+    scale = 10**digits
+    return (values * scale + 0.5) // 1 / scale
+
+
+def _grouped(values, option):
+    # Rows of a dimension grouping set for a traffic or label option: null in the rows grouped
+    # across every value of the dimension
+    selected = DIMENSION_VALUES[option]
+    return values.isna() if len(selected) > 1 else values == selected[0]
+
+
+def rollup_dimensions(key, data, traffic, label):
+    # The rows of a DIMENSION_PARAMS query for the selected options, aggregated the way the PARAMS
+    # query would. The queries return a row per grouping set of the dimensions, so counts (sessions
+    # included) are exact, or HLL estimates of sessions from the rollups.
+    if key == "logs_query":
+        selected = data[
+            data["TRAFFIC_SOURCE"].isin(DIMENSION_VALUES[traffic])
+            & data["VERSION_LABEL"].isin(DIMENSION_VALUES[label])
+        ]
+        rows = selected.sort_values("TIMESTAMP", ascending=False).head(10)
+        return rows[QUERY_COLUMNS[key]].reset_index(drop=True)
+
+    selected = data[
+        _grouped(data["TRAFFIC_SOURCE"], traffic) & _grouped(data["VERSION_LABEL"], label)
+    ]
+    columns = QUERY_COLUMNS[key]
+    counts = ["SEARCHES", "SESSIONS", "CLICKS", "CLICKED_SEARCHES", "KG_SEARCHES"]
+    rows = selected.groupby(columns[0], as_index=False, observed=True)[
+        [c for c in counts if c in selected]
+    ].sum()
+    rows["CTR"] = (rows["CLICKED_SEARCHES"] / rows["SEARCHES"]).fillna(0)
+    if "KG_SEARCHES" in rows:
+        rows["KG_RESULT_RATE"] = round_half_up((rows["KG_SEARCHES"] / rows["SEARCHES"]).fillna(0))
+    if key in ["analytics_query", "cluster_query", "results_query"]:
+        rows["CTR"] = round_half_up(rows["CTR"])
+
+    if key == "cluster_query":
+        rows = rows.sort_values("SEARCHES", ascending=False).head(10)
+    elif key != "analytics_query":
+        rows = rows[rows["CLICKS"] > 0]
+        rows = rows.sort_values(["CLICKS", "SEARCHES"], ascending=False).head(10)
+    if "SESSIONS_HLL" in selected:
+        rows = merge_sessions(rows, selected, columns[0])
+    return rows[columns].reset_index(drop=True)
+
+
+def merge_sessions(rows, sketches, column):
+    # SESSIONS of each row from the merged HLL sketches of the `sketches` rows with the same
+    # `column` value, and the distinct sessions across all of them in attrs["sessions"]
+    sketches = sketches[sketches[column].isin(rows[column])]
+    merged = {k: hll.merge(s) for k, s in sketches.groupby(column, observed=True)["SESSIONS_HLL"]}
+    rows = rows.assign(SESSIONS=[hll.estimate(merged.get(k)) for k in rows[column]])
+    rows.attrs["sessions"] = hll.estimate(hll.merge(merged.values()))
+    return rows
+
+
+def total_sessions(data):
+    # Distinct sessions across the days of an analytics frame when they came as sketches, otherwise
+    # the sum of the days' (counting sessions that span days once a day)
+    return data.attrs.get("sessions", int(data["SESSIONS"].sum()))
+
+
+def sketch_query(query):
+    # A daily query returning each row's sessions as an HLL_EXPORT sketch (SESSIONS_HLL) in place of
+    # a distinct count, so rows can be merged into distinct sessions for any window or filter
+    for count, sketch in SKETCH_REWRITES:
+        query = query.replace(count, sketch)
+    return query
+
+
+def split_combined(data):
+    # Split the tagged rows of a combined query into one frame per PARAMS key
+    frames = {}
+    for key in PARAMS["combined_query_keys"]["Cluster"]:
+        columns = QUERY_COLUMNS[key]
+        rows = data[data["TAB"] == key]
+        # Analytics rows are keyed by their DATE column, the tabs by the generic KEY column
+        if columns[0] != "DATE":
+            rows = rows.rename(columns={"KEY": columns[0]})
+        frames[key] = rows[columns].reset_index(drop=True)
+    return frames
+
+
+def sql_list(values):
+    # Quoted SQL list of strings, e.g. the popular terms for the batch queries' {terms} when they're
+    # formatted in
+    return ", ".join("'" + str(v).replace("'", "''") + "'" for v in values)
+
+
+def term_rows(table, term):
+    # A batch query's rows for one term, without the TERM column
+    return table.filter(pc.equal(table["TERM"], term)).drop(["TERM"])
+
+
+def likely_terms(popular, term, related, n):
+    # Terms an analyst is likely to open next: the next `n` down the popular list, then related
+    # terms that are on it too
+    following = popular[popular.index(term) + 1 :][:n]
+    return following + [t for t in related if t in popular and t not in following + [term]][:n]
+
+
+def _is_rolled_up(key):
+    return ROLLUP_QUERIES and key in ROLLUP_PARAMS
+
+
+def _is_batched(key):
+    return BATCH_POPULAR_TERMS and key in BATCH_PARAMS and not _is_rolled_up(key)
+
+
+def _is_dimensioned(key):
+    return (
+        (DIMENSION_FILTERS or _is_rolled_up(key))
+        and key in DIMENSION_PARAMS
+        and not _is_batched(key)
+    )
+
+
+def _is_windowed(key):
+    # The analytics (and dimension logs) queries are daily, so can be fetched once for every date
+    # window. The dimension tab queries aren't: a row per day, dimension and term or entity is far
+    # more rows than the tab shows, so they're fetched for the selected window.
+    return DERIVE_DATE_WINDOWS and (
+        key == "analytics_query" or (key == "logs_query" and _is_dimensioned(key))
+    )
+
+
+def _is_combined(key, mode):
+    return (
+        COMBINED_QUERIES
+        and key in PARAMS["combined_query_keys"][mode]
+        and not _is_windowed(key)
+        and not _is_dimensioned(key)
+        and not _is_batched(key)
+    )
+
+
+def _is_sketched(key):
+    # Daily results, which are re-aggregated locally for the date window and filters
+    return SKETCH_SESSIONS and _is_windowed(key)
+
+
+def is_incremental(key):
+    return INCREMENTAL_REFRESH and _is_windowed(key)
+
+
+def rollup_query(key, mode):
+    # A DIMENSION_PARAMS query rewritten to add up the key's rollup table (ROLLUP_READS) for the days
+    # up to its watermark and the raw tables for the days after it (usually just today), then group
+    # and cut the total the way the raw query does. Sessions are merged from both parts' sketches.
+    start = "dateadd('day', {d}, current_date())"
+    watermark = (
+        "(select max(through_date) from search_rollup_watermarks"
+        f" where table_name = '{ROLLUP_TABLES[key]}')"
+    )
+    # The searches after the watermark, filtered before the joins: a predicate on the watermark
+    # subquery in the where clause is only applied after every search of the window is joined
+    after = f"(select * from searches where date(timestamp) > coalesce({watermark}, {start}))"
+    raw, found = re.subn(
+        r"(\n        |join )searches(\n| on )",
+        lambda match: f"{match[1]}{after} searches{match[2]}",
+        DIMENSION_PARAMS[key][mode],
+    )
+    assert found == 1, f"No searches table to filter in the {key} query"
+    # The raw query's per_search rows, and its select of them by grouping set
+    ctes, select = raw.split("\n)\nselect\n")
+    columns, grouping = select.split("\nfrom per_search\n")
+
+    def rewrite(text, rewrites):
+        for old, new in rewrites:
+            text = text.replace(old, new)
+        return text
+
+    part = textwrap.indent(
+        f"select\n{rewrite(columns, ROLLUP_PARTS)}\nfrom per_search\ngroup by 1, 2, 3\nunion all"
+        + ROLLUP_READS[key][mode].rstrip(),
+        "    ",
+    )
+    return (
+        f"{ctes}\n),\nparts as (\n{part}\n)\n"
+        f"select\n{rewrite(columns, ROLLUP_TOTALS)}\nfrom parts\n{rewrite(grouping, ROLLUP_TOTALS)}"
+    )
+
+
+def query_template(key, mode):
+    if _is_rolled_up(key):
+        template = ROLLUP_PARAMS[key][mode]
+    elif _is_batched(key):
+        template = BATCH_PARAMS[key][mode]
+    elif _is_dimensioned(key):
+        template = DIMENSION_PARAMS[key][mode]
+    elif _is_combined(key, mode):
+        template = PARAMS["combined_query"][mode]
+    else:
+        template = PARAMS[key][mode]
+    return sketch_query(template) if _is_sketched(key) else template
+
+
+@lru_cache(maxsize=None)
+def compile_template(template):
+    # A query template with its {name} placeholders (quoted or not) replaced by numeric bind
+    # variables, and the names in the order they're bound. A name used more than once reuses its
+    # variables, and traffic and label options become `in (...)` lists.
+    names = []
+
+    def replace(match):
+        name = match.group(1)
+        if name not in names:
+            names.append(name)
+        start = 1 + sum(BIND_COUNTS.get(n, 1) for n in names[: names.index(name)])
+        binds = ", ".join(f":{start + i}" for i in range(BIND_COUNTS.get(name, 1)))
+        return f"in ({binds})" if name in ["t", "l"] else binds
+
+    return re.sub(r"'?\{(\w+)\}'?", replace, template), tuple(names)
+
+
+def _bind_values(name, filter):
+    # Values bound for a placeholder, padded with repeats of the last to the variables it has
+    if name == "t":
+        values = DIMENSION_VALUES[filter["traffic"]]
+    elif name == "l":
+        values = DIMENSION_VALUES[filter["label"]]
+    elif name == "terms":
+        values = filter["terms"]
+    else:
+        values = [filter[name]]
+    count = BIND_COUNTS.get(name, 1)
+    assert 0 < len(values) <= count, f"Can't bind {len(values)} values to {{{name}}}"
+    return list(values) + [values[-1]] * (count - len(values))
+
+
+def bind_query(template, filter):
+    # (SQL, parameters) running a template for the filter. The SQL is the same for every filter
+    # with bind variables, or has the filter formatted in (and no parameters) without.
+    if not BIND_PARAMETERS:
+        if "terms" in filter:
+            filter = {**filter, "terms": sql_list(filter["terms"])}
+        return template.format(**filter), None
+    sql, names = compile_template(template)
+    return sql, tuple(v for name in names for v in _bind_values(name, filter))
+
+
+def details_query(key, mode, filter):
+    # Query serving a PARAMS query for the filter, which may cover more dates, filters or tabs
+    if _is_windowed(key):
+        filter = {**filter, "d": WIDEST_DATE_OFFSET}
+    return bind_query(query_template(key, mode), filter)
+
+
+def top_up_query(key, mode, filter, created):
+    # Query for the days since the last complete one before `created`, and the offset to merge at
+    today = pd.Timestamp.today().normalize()
+    last_complete = pd.Timestamp.fromtimestamp(created).normalize() - pd.Timedelta(days=1)
+    d = (last_complete - today).days
+    # Fetch one more day than needed, in case Snowflake's current date differs from ours
+    return bind_query(query_template(key, mode), {**filter, "d": d - 1}), d
+
+
+def shape_details(key, mode, table, filter, columns=None):
+    # Frame for a PARAMS query out of the Arrow results of details_query, optionally with only
+    # `columns` of it
+    if _is_batched(key):
+        table = term_rows(table, filter["s"])
+    if _is_windowed(key):
+        table = date_window(table, filter["d"], date_column(key))
+    if _is_dimensioned(key):
+        data = to_frame(table)
+        details = rollup_dimensions(key, data, filter["traffic"], filter["label"])
+    elif _is_combined(key, mode):
+        data = to_frame(table)
+        details = split_combined(data)[key]
+    elif _is_sketched(key):
+        data = to_frame(table)
+        details = merge_sessions(data, data, "DATE")[QUERY_COLUMNS[key]]
+    else:
+        return to_frame(table, columns)
+    details.attrs = {**data.attrs, **details.attrs}
+    return details if columns is None else details[columns]
+
+
 DATE_OPTIONS = ["Last 7 Days", "Last 30 Days", "Last 90 Days", "Last 12 Weeks"]
 TRAFFIC_OPTIONS = ["All Traffic", "External", "Internal"]
 LABEL_OPTIONS = ["All Configuration Labels", "STAGING", "PRODUCTION"]
@@ -30,6 +411,7 @@ MAP = {
     "STAGING": "= 'STAGING'",
     "PRODUCTION": "= 'PRODUCTION'",
 }
+WIDEST_DATE_OFFSET = min(MAP[d] for d in DATE_OPTIONS)
 
 
 POPULAR_SEARCH_TERMS = """
@@ -368,42 +750,1609 @@ order by 1 desc
 limit 10
 """
 
-PARAMS = {
-    "popular_query": {
-        "Search Term": POPULAR_SEARCH_TERMS,
-        "Cluster": POPULAR_CLUSTERS,
-    },
-    "popular_query_col": {
-        "Search Term": "TOKENIZER_NORMALIZED_QUERY",
-        "Cluster": "CLUSTER_NAME",
-    },
-    "head": {"Search Term": "Search Terms", "Cluster": "Search Term Clusters"},
-    "url": {
-        "Search Term": "https://www.yext.com/s/{}/answers/experiences/{}/uniqueQueries",
-        "Cluster": "https://www.yext.com/s/{}/answers/experiences/{}/clusters",
-    },
-    "analytics_query": {
-        "Search Term": ANALYTICS_QUERY,
-        "Cluster": ANALYTICS_QUERY_C,
-    },
-    "cluster_query": {
-        "Search Term": CLUSTER_QUERY,
-        "Cluster": CLUSTER_QUERY_C,
-    },
-    "results_query": {
-        "Search Term": RESULTS_QUERY,
-        "Cluster": RESULTS_QUERY_C,
-    },
-    "vertical_query": {
-        "Search Term": VERTICALS_QUERY,
-        "Cluster": VERTICALS_QUERY_C,
-    },
-    "source_query": {
-        "Search Term": SOURCE_QUERY,
-        "Cluster": SOURCE_QUERY_C,
-    },
-    "logs_query": {
-        "Search Term": LOGS_QUERY,
-        "Cluster": LOGS_QUERY_C,
-    },
-}
+# Same queries for every traffic source and version label option at once, so every filter combination
+# is served from one fetch (see rollup_dimensions): a row per search, then a row per grouping set of
+# the two (null for all of a dimension's values), so each combination's sessions are counted once.
+# The analytics are still by day; the tabs keep their top 10 rows for each combination.
+ANALYTICS_DIMS_QUERY = """
+with per_search as (
+    select
+        date(searches.timestamp) as date,
+        user_data.traffic_source,
+        searches.version_label,
+        searches.query_id,
+        user_data.session_id,
+        searches.has_kg_results,
+        count(case when user_event_types.is_click_event then 1 end) as clicks
+    from
+        searches
+        join user_data on searches.id = user_data.search_id
+        left join user_events on searches.id = user_events.search_id
+        left join user_event_types on user_events.user_event_type_id = user_event_types.id
+    where
+        date(searches.timestamp) > dateadd('day', {d}, current_date())
+        and user_data.traffic_source in ('EXTERNAL', 'INTERNAL')
+        and searches.version_label in ('STAGING', 'PRODUCTION')
+        and searches.business_id = {b}
+        and searches.experience_key = '{e}'
+        and searches.tokenizer_normalized_query = '{s}'
+    group by 1, 2, 3, 4, 5, 6
+)
+select
+    date,
+    traffic_source,
+    version_label,
+    count(distinct session_id) as sessions,
+    count(*) as searches,
+    sum(clicks) as clicks,
+    count(case when clicks > 0 then 1 end) as clicked_searches,
+    count(case when has_kg_results then 1 end) as kg_searches
+from per_search
+group by grouping sets (
+    (date, traffic_source, version_label),
+    (date, traffic_source),
+    (date, version_label),
+    (date)
+)
+"""
+
+ANALYTICS_DIMS_QUERY_C = """
+with per_search as (
+    select
+        date(searches.timestamp) as date,
+        user_data.traffic_source,
+        searches.version_label,
+        searches.query_id,
+        user_data.session_id,
+        searches.has_kg_results,
+        count(case when user_event_types.is_click_event then 1 end) as clicks
+    from
+        searches
+        join user_data on searches.id = user_data.search_id
+        join current_cluster_search_terms on searches.business_id = current_cluster_search_terms.business_id and searches.experience_key = current_cluster_search_terms.experience_key and searches.tokenizer_normalized_query = current_cluster_search_terms.search_term
+        left join user_events on searches.id = user_events.search_id
+        left join user_event_types on user_events.user_event_type_id = user_event_types.id
+    where
+        date(searches.timestamp) > dateadd('day', {d}, current_date())
+        and user_data.traffic_source in ('EXTERNAL', 'INTERNAL')
+        and searches.version_label in ('STAGING', 'PRODUCTION')
+        and searches.business_id = {b}
+        and searches.experience_key = '{e}'
+        and current_cluster_search_terms.cluster_name = '{s}'
+    group by 1, 2, 3, 4, 5, 6
+)
+select
+    date,
+    traffic_source,
+    version_label,
+    count(distinct session_id) as sessions,
+    count(*) as searches,
+    sum(clicks) as clicks,
+    count(case when clicks > 0 then 1 end) as clicked_searches,
+    count(case when has_kg_results then 1 end) as kg_searches
+from per_search
+group by grouping sets (
+    (date, traffic_source, version_label),
+    (date, traffic_source),
+    (date, version_label),
+    (date)
+)
+"""
+
+CLUSTER_DIMS_QUERY = """
+with cluster as (
+    select business_id, experience_key, cluster_id
+    from current_cluster_search_terms
+    where
+        search_term = '{s}'
+        and business_id = {b}
+        and experience_key = '{e}'
+        and not is_noise
+        and not is_overlarge
+),
+per_search as (
+    select
+        search_term,
+        user_data.traffic_source,
+        searches.version_label,
+        searches.query_id,
+        user_data.session_id,
+        count(case when user_event_types.is_click_event then 1 end) as clicks
+    from
+        cluster
+        join current_cluster_search_terms using (business_id, experience_key, cluster_id)
+        left join searches on searches.business_id = cluster.business_id and searches.experience_key = cluster.experience_key and searches.tokenizer_normalized_query = current_cluster_search_terms.search_term
+        left join user_data on searches.id = user_data.search_id
+        left join user_events on searches.id = user_events.search_id
+        left join user_event_types on user_events.user_event_type_id = user_event_types.id
+    where
+        date(searches.timestamp) > dateadd('day', {d}, current_date())
+        and user_data.traffic_source in ('EXTERNAL', 'INTERNAL')
+        and searches.version_label in ('STAGING', 'PRODUCTION')
+        and search_term != '{s}'
+    group by 1, 2, 3, 4, 5
+)
+select
+    search_term,
+    traffic_source,
+    version_label,
+    count(*) as searches,
+    count(distinct session_id) as sessions,
+    sum(clicks) as clicks,
+    count(case when clicks > 0 then 1 end) as clicked_searches
+from per_search
+group by grouping sets (
+    (search_term, traffic_source, version_label),
+    (search_term, traffic_source),
+    (search_term, version_label),
+    (search_term)
+)
+qualify row_number() over (partition by traffic_source, version_label order by count(*) desc) <= 10
+"""
+
+CLUSTER_DIMS_QUERY_C = """
+with per_search as (
+    select
+        current_cluster_search_terms.search_term,
+        user_data.traffic_source,
+        searches.version_label,
+        searches.query_id,
+        user_data.session_id,
+        count(case when user_event_types.is_click_event then 1 end) as clicks
+    from
+        searches
+        join user_data on searches.id = user_data.search_id
+        join current_cluster_search_terms on searches.business_id = current_cluster_search_terms.business_id and searches.experience_key = current_cluster_search_terms.experience_key and searches.tokenizer_normalized_query = current_cluster_search_terms.search_term
+        left join user_events on searches.id = user_events.search_id
+        left join user_event_types on user_events.user_event_type_id = user_event_types.id
+    where
+        date(searches.timestamp) > dateadd('day', {d}, current_date())
+        and user_data.traffic_source in ('EXTERNAL', 'INTERNAL')
+        and searches.version_label in ('STAGING', 'PRODUCTION')
+        and searches.business_id = {b}
+        and searches.experience_key = '{e}'
+        and current_cluster_search_terms.cluster_name = '{s}'
+    group by 1, 2, 3, 4, 5
+)
+select
+    search_term,
+    traffic_source,
+    version_label,
+    count(*) as searches,
+    count(distinct session_id) as sessions,
+    sum(clicks) as clicks,
+    count(case when clicks > 0 then 1 end) as clicked_searches
+from per_search
+group by grouping sets (
+    (search_term, traffic_source, version_label),
+    (search_term, traffic_source),
+    (search_term, version_label),
+    (search_term)
+)
+qualify row_number() over (partition by traffic_source, version_label order by count(*) desc) <= 10
+"""
+
+RESULTS_DIMS_QUERY = """
+with per_search as (
+    select
+        results.entity_id,
+        user_data.traffic_source,
+        searches.version_label,
+        searches.query_id,
+        user_data.session_id,
+        count(case when user_event_types.is_click_event then 1 end) as clicks
+    from
+        searches
+        left join user_data on searches.id = user_data.search_id
+        left join vertical_searchers on searches.id = vertical_searchers.search_id
+        left join results on vertical_searchers.id = results.vertical_searcher_id
+        left join user_events on searches.id = user_events.search_id and vertical_searchers.id = user_events.vertical_searcher_id and results.entity_id = user_events.entity_id
+        left join user_event_types on user_events.user_event_type_id = user_event_types.id
+    where
+        date(searches.timestamp) > dateadd('day', {d}, current_date())
+        and user_data.traffic_source in ('EXTERNAL', 'INTERNAL')
+        and searches.version_label in ('STAGING', 'PRODUCTION')
+        and searches.business_id = {b}
+        and searches.experience_key = '{e}'
+        and searches.tokenizer_normalized_query = '{s}'
+    group by 1, 2, 3, 4, 5
+)
+select
+    entity_id,
+    traffic_source,
+    version_label,
+    count(*) as searches,
+    count(distinct session_id) as sessions,
+    sum(clicks) as clicks,
+    count(case when clicks > 0 then 1 end) as clicked_searches
+from per_search
+group by grouping sets (
+    (entity_id, traffic_source, version_label),
+    (entity_id, traffic_source),
+    (entity_id, version_label),
+    (entity_id)
+)
+qualify sum(clicks) > 0 and row_number() over (partition by traffic_source, version_label order by sum(clicks) desc, count(*) desc) <= 10
+"""
+
+RESULTS_DIMS_QUERY_C = """
+with per_search as (
+    select
+        results.entity_id,
+        user_data.traffic_source,
+        searches.version_label,
+        searches.query_id,
+        user_data.session_id,
+        count(case when user_event_types.is_click_event then 1 end) as clicks
+    from
+        searches
+        join user_data on searches.id = user_data.search_id
+        join current_cluster_search_terms on searches.business_id = current_cluster_search_terms.business_id and searches.experience_key = current_cluster_search_terms.experience_key and searches.tokenizer_normalized_query = current_cluster_search_terms.search_term
+        left join vertical_searchers on searches.id = vertical_searchers.search_id
+        left join results on vertical_searchers.id = results.vertical_searcher_id
+        left join user_events on searches.id = user_events.search_id and vertical_searchers.id = user_events.vertical_searcher_id and results.entity_id = user_events.entity_id
+        left join user_event_types on user_events.user_event_type_id = user_event_types.id
+    where
+        date(searches.timestamp) > dateadd('day', {d}, current_date())
+        and user_data.traffic_source in ('EXTERNAL', 'INTERNAL')
+        and searches.version_label in ('STAGING', 'PRODUCTION')
+        and searches.business_id = {b}
+        and searches.experience_key = '{e}'
+        and current_cluster_search_terms.cluster_name = '{s}'
+    group by 1, 2, 3, 4, 5
+)
+select
+    entity_id,
+    traffic_source,
+    version_label,
+    count(*) as searches,
+    count(distinct session_id) as sessions,
+    sum(clicks) as clicks,
+    count(case when clicks > 0 then 1 end) as clicked_searches
+from per_search
+group by grouping sets (
+    (entity_id, traffic_source, version_label),
+    (entity_id, traffic_source),
+    (entity_id, version_label),
+    (entity_id)
+)
+qualify sum(clicks) > 0 and row_number() over (partition by traffic_source, version_label order by sum(clicks) desc, count(*) desc) <= 10
+"""
+
+VERTICALS_DIMS_QUERY = """
+with per_search as (
+    select
+        vertical_searchers.vertical_id,
+        user_data.traffic_source,
+        searches.version_label,
+        searches.query_id,
+        user_data.session_id,
+        count(case when user_event_types.is_click_event then 1 end) as clicks
+    from
+        searches
+        left join user_data on searches.id = user_data.search_id
+        left join vertical_searchers on searches.id = vertical_searchers.search_id
+        left join user_events on searches.id = user_events.search_id and vertical_searchers.id = user_events.vertical_searcher_id
+        left join user_event_types on user_events.user_event_type_id = user_event_types.id
+    where
+        date(searches.timestamp) > dateadd('day', {d}, current_date())
+        and user_data.traffic_source in ('EXTERNAL', 'INTERNAL')
+        and searches.version_label in ('STAGING', 'PRODUCTION')
+        and searches.business_id = {b}
+        and searches.experience_key = '{e}'
+        and searches.tokenizer_normalized_query = '{s}'
+    group by 1, 2, 3, 4, 5
+)
+select
+    vertical_id,
+    traffic_source,
+    version_label,
+    count(*) as searches,
+    count(distinct session_id) as sessions,
+    sum(clicks) as clicks,
+    count(case when clicks > 0 then 1 end) as clicked_searches
+from per_search
+group by grouping sets (
+    (vertical_id, traffic_source, version_label),
+    (vertical_id, traffic_source),
+    (vertical_id, version_label),
+    (vertical_id)
+)
+qualify sum(clicks) > 0 and row_number() over (partition by traffic_source, version_label order by sum(clicks) desc, count(*) desc) <= 10
+"""
+
+VERTICALS_DIMS_QUERY_C = """
+with per_search as (
+    select
+        vertical_searchers.vertical_id,
+        user_data.traffic_source,
+        searches.version_label,
+        searches.query_id,
+        user_data.session_id,
+        count(case when user_event_types.is_click_event then 1 end) as clicks
+    from
+        searches
+        join user_data on searches.id = user_data.search_id
+        join current_cluster_search_terms on searches.business_id = current_cluster_search_terms.business_id and searches.experience_key = current_cluster_search_terms.experience_key and searches.tokenizer_normalized_query = current_cluster_search_terms.search_term
+        left join vertical_searchers on searches.id = vertical_searchers.search_id
+        left join user_events on searches.id = user_events.search_id and vertical_searchers.id = user_events.vertical_searcher_id
+        left join user_event_types on user_events.user_event_type_id = user_event_types.id
+    where
+        date(searches.timestamp) > dateadd('day', {d}, current_date())
+        and user_data.traffic_source in ('EXTERNAL', 'INTERNAL')
+        and searches.version_label in ('STAGING', 'PRODUCTION')
+        and searches.business_id = {b}
+        and searches.experience_key = '{e}'
+        and current_cluster_search_terms.cluster_name = '{s}'
+    group by 1, 2, 3, 4, 5
+)
+select
+    vertical_id,
+    traffic_source,
+    version_label,
+    count(*) as searches,
+    count(distinct session_id) as sessions,
+    sum(clicks) as clicks,
+    count(case when clicks > 0 then 1 end) as clicked_searches
+from per_search
+group by grouping sets (
+    (vertical_id, traffic_source, version_label),
+    (vertical_id, traffic_source),
+    (vertical_id, version_label),
+    (vertical_id)
+)
+qualify sum(clicks) > 0 and row_number() over (partition by traffic_source, version_label order by sum(clicks) desc, count(*) desc) <= 10
+"""
+
+SOURCE_DIMS_QUERY = """
+with per_search as (
+    select
+        user_data.query_source,
+        user_data.traffic_source,
+        searches.version_label,
+        searches.query_id,
+        user_data.session_id,
+        count(case when user_event_types.is_click_event then 1 end) as clicks
+    from
+        searches
+        left join user_data on searches.id = user_data.search_id
+        left join user_events on searches.id = user_events.search_id
+        left join user_event_types on user_events.user_event_type_id = user_event_types.id
+    where
+        date(searches.timestamp) > dateadd('day', {d}, current_date())
+        and user_data.traffic_source in ('EXTERNAL', 'INTERNAL')
+        and searches.version_label in ('STAGING', 'PRODUCTION')
+        and searches.business_id = {b}
+        and searches.experience_key = '{e}'
+        and searches.tokenizer_normalized_query = '{s}'
+    group by 1, 2, 3, 4, 5
+)
+select
+    query_source,
+    traffic_source,
+    version_label,
+    count(*) as searches,
+    count(distinct session_id) as sessions,
+    sum(clicks) as clicks,
+    count(case when clicks > 0 then 1 end) as clicked_searches
+from per_search
+group by grouping sets (
+    (query_source, traffic_source, version_label),
+    (query_source, traffic_source),
+    (query_source, version_label),
+    (query_source)
+)
+qualify sum(clicks) > 0 and row_number() over (partition by traffic_source, version_label order by sum(clicks) desc, count(*) desc) <= 10
+"""
+
+SOURCE_DIMS_QUERY_C = """
+with per_search as (
+    select
+        user_data.query_source,
+        user_data.traffic_source,
+        searches.version_label,
+        searches.query_id,
+        user_data.session_id,
+        count(case when user_event_types.is_click_event then 1 end) as clicks
+    from
+        searches
+        join user_data on searches.id = user_data.search_id
+        join current_cluster_search_terms on searches.business_id = current_cluster_search_terms.business_id and searches.experience_key = current_cluster_search_terms.experience_key and searches.tokenizer_normalized_query = current_cluster_search_terms.search_term
+        left join user_events on searches.id = user_events.search_id
+        left join user_event_types on user_events.user_event_type_id = user_event_types.id
+    where
+        date(searches.timestamp) > dateadd('day', {d}, current_date())
+        and user_data.traffic_source in ('EXTERNAL', 'INTERNAL')
+        and searches.version_label in ('STAGING', 'PRODUCTION')
+        and searches.business_id = {b}
+        and searches.experience_key = '{e}'
+        and current_cluster_search_terms.cluster_name = '{s}'
+    group by 1, 2, 3, 4, 5
+)
+select
+    query_source,
+    traffic_source,
+    version_label,
+    count(*) as searches,
+    count(distinct session_id) as sessions,
+    sum(clicks) as clicks,
+    count(case when clicks > 0 then 1 end) as clicked_searches
+from per_search
+group by grouping sets (
+    (query_source, traffic_source, version_label),
+    (query_source, traffic_source),
+    (query_source, version_label),
+    (query_source)
+)
+qualify sum(clicks) > 0 and row_number() over (partition by traffic_source, version_label order by sum(clicks) desc, count(*) desc) <= 10
+"""
+
+LOGS_DIMS_QUERY = """
+select
+    searches.timestamp,
+    user_data.traffic_source,
+    searches.version_label,
+    searches.query_id,
+    searches.tokenizer_normalized_query as query,
+    concat(user_data.city, ', ', user_data.region) as city,
+    user_data.country,
+    concat(user_data.latitude, ', ', user_data.longitude) as "LAT, LONG"
+from searches
+left join user_data on searches.id = user_data.search_id
+where
+    date(searches.timestamp) > dateadd('day', {d}, current_date())
+    and searches.business_id = {b}
+    and searches.experience_key = '{e}'
+    and searches.tokenizer_normalized_query = '{s}'
+qualify row_number() over (partition by user_data.traffic_source, searches.version_label order by searches.timestamp desc) <= 10
+"""
+
+LOGS_DIMS_QUERY_C = """
+select
+    searches.timestamp,
+    user_data.traffic_source,
+    searches.version_label,
+    searches.query_id,
+    searches.tokenizer_normalized_query as query,
+    concat(user_data.city, ', ', user_data.region) as city,
+    user_data.country,
+    concat(user_data.latitude, ', ', user_data.longitude) as "LAT, LONG"
+from
+    searches
+    join user_data on searches.id = user_data.search_id
+    join current_cluster_search_terms on searches.business_id = current_cluster_search_terms.business_id and searches.experience_key = current_cluster_search_terms.experience_key and searches.tokenizer_normalized_query = current_cluster_search_terms.search_term
+where
+    date(searches.timestamp) > dateadd('day', {d}, current_date())
+    and searches.business_id = {b}
+    and searches.experience_key = '{e}'
+    and current_cluster_search_terms.cluster_name = '{s}'
+qualify row_number() over (partition by user_data.traffic_source, searches.version_label order by searches.timestamp desc) <= 10
+"""
+
+# Reads of the daily rollup tables (built by rollup.py) for the days up to the table's watermark,
+# added up across the window for each traffic source and label (by day for the analytics). Sessions
+# stay HLL sketches, to merge with the raw part of the rollup query (see rollup_query); the other
+# counts are per search, so they add up exactly across days, filters and terms.
+ANALYTICS_ROLLUP_QUERY = """
+select
+    date,
+    traffic_source,
+    version_label,
+    hll_combine(sessions_hll) as sessions_hll,
+    sum(searches) as searches,
+    sum(clicks) as clicks,
+    sum(clicked_searches) as clicked_searches,
+    sum(kg_searches) as kg_searches
+from search_term_daily
+where
+    date > dateadd('day', {d}, current_date())
+    and traffic_source in ('EXTERNAL', 'INTERNAL')
+    and version_label in ('STAGING', 'PRODUCTION')
+    and date <= (select max(through_date) from search_rollup_watermarks where table_name = 'search_term_daily')
+    and business_id = {b}
+    and experience_key = '{e}'
+    and search_term = '{s}'
+group by 1, 2, 3
+"""
+
+ANALYTICS_ROLLUP_QUERY_C = """
+select
+    date,
+    traffic_source,
+    version_label,
+    hll_combine(sessions_hll) as sessions_hll,
+    sum(searches) as searches,
+    sum(clicks) as clicks,
+    sum(clicked_searches) as clicked_searches,
+    sum(kg_searches) as kg_searches
+from
+    search_term_daily
+    join current_cluster_search_terms using (business_id, experience_key, search_term)
+where
+    date > dateadd('day', {d}, current_date())
+    and traffic_source in ('EXTERNAL', 'INTERNAL')
+    and version_label in ('STAGING', 'PRODUCTION')
+    and date <= (select max(through_date) from search_rollup_watermarks where table_name = 'search_term_daily')
+    and business_id = {b}
+    and experience_key = '{e}'
+    and current_cluster_search_terms.cluster_name = '{s}'
+group by 1, 2, 3
+"""
+
+CLUSTER_ROLLUP_QUERY = """
+select
+    search_term,
+    traffic_source,
+    version_label,
+    sum(searches) as searches,
+    hll_combine(sessions_hll) as sessions_hll,
+    sum(clicks) as clicks,
+    sum(clicked_searches) as clicked_searches
+from
+    search_term_daily
+    join current_cluster_search_terms using (business_id, experience_key, search_term)
+    join (
+        select business_id, experience_key, cluster_id
+        from current_cluster_search_terms
+        where
+            search_term = '{s}'
+            and business_id = {b}
+            and experience_key = '{e}'
+            and not is_noise
+            and not is_overlarge
+    ) cluster using (business_id, experience_key, cluster_id)
+where
+    date > dateadd('day', {d}, current_date())
+    and traffic_source in ('EXTERNAL', 'INTERNAL')
+    and version_label in ('STAGING', 'PRODUCTION')
+    and date <= (select max(through_date) from search_rollup_watermarks where table_name = 'search_term_daily')
+    and search_term != '{s}'
+group by 1, 2, 3
+"""
+
+CLUSTER_ROLLUP_QUERY_C = """
+select
+    search_term,
+    traffic_source,
+    version_label,
+    sum(searches) as searches,
+    hll_combine(sessions_hll) as sessions_hll,
+    sum(clicks) as clicks,
+    sum(clicked_searches) as clicked_searches
+from
+    search_term_daily
+    join current_cluster_search_terms using (business_id, experience_key, search_term)
+where
+    date > dateadd('day', {d}, current_date())
+    and traffic_source in ('EXTERNAL', 'INTERNAL')
+    and version_label in ('STAGING', 'PRODUCTION')
+    and date <= (select max(through_date) from search_rollup_watermarks where table_name = 'search_term_daily')
+    and business_id = {b}
+    and experience_key = '{e}'
+    and current_cluster_search_terms.cluster_name = '{s}'
+group by 1, 2, 3
+"""
+
+RESULTS_ROLLUP_QUERY = """
+select
+    entity_id,
+    traffic_source,
+    version_label,
+    sum(searches) as searches,
+    hll_combine(sessions_hll) as sessions_hll,
+    sum(clicks) as clicks,
+    sum(clicked_searches) as clicked_searches
+from search_term_entity_daily
+where
+    date > dateadd('day', {d}, current_date())
+    and traffic_source in ('EXTERNAL', 'INTERNAL')
+    and version_label in ('STAGING', 'PRODUCTION')
+    and date <= (select max(through_date) from search_rollup_watermarks where table_name = 'search_term_entity_daily')
+    and business_id = {b}
+    and experience_key = '{e}'
+    and search_term = '{s}'
+group by 1, 2, 3
+"""
+
+RESULTS_ROLLUP_QUERY_C = """
+select
+    entity_id,
+    traffic_source,
+    version_label,
+    sum(searches) as searches,
+    hll_combine(sessions_hll) as sessions_hll,
+    sum(clicks) as clicks,
+    sum(clicked_searches) as clicked_searches
+from
+    search_term_entity_daily
+    join current_cluster_search_terms using (business_id, experience_key, search_term)
+where
+    date > dateadd('day', {d}, current_date())
+    and traffic_source in ('EXTERNAL', 'INTERNAL')
+    and version_label in ('STAGING', 'PRODUCTION')
+    and date <= (select max(through_date) from search_rollup_watermarks where table_name = 'search_term_entity_daily')
+    and business_id = {b}
+    and experience_key = '{e}'
+    and current_cluster_search_terms.cluster_name = '{s}'
+group by 1, 2, 3
+"""
+
+VERTICALS_ROLLUP_QUERY = """
+select
+    vertical_id,
+    traffic_source,
+    version_label,
+    sum(searches) as searches,
+    hll_combine(sessions_hll) as sessions_hll,
+    sum(clicks) as clicks,
+    sum(clicked_searches) as clicked_searches
+from search_term_vertical_daily
+where
+    date > dateadd('day', {d}, current_date())
+    and traffic_source in ('EXTERNAL', 'INTERNAL')
+    and version_label in ('STAGING', 'PRODUCTION')
+    and date <= (select max(through_date) from search_rollup_watermarks where table_name = 'search_term_vertical_daily')
+    and business_id = {b}
+    and experience_key = '{e}'
+    and search_term = '{s}'
+group by 1, 2, 3
+"""
+
+VERTICALS_ROLLUP_QUERY_C = """
+select
+    vertical_id,
+    traffic_source,
+    version_label,
+    sum(searches) as searches,
+    hll_combine(sessions_hll) as sessions_hll,
+    sum(clicks) as clicks,
+    sum(clicked_searches) as clicked_searches
+from
+    search_term_vertical_daily
+    join current_cluster_search_terms using (business_id, experience_key, search_term)
+where
+    date > dateadd('day', {d}, current_date())
+    and traffic_source in ('EXTERNAL', 'INTERNAL')
+    and version_label in ('STAGING', 'PRODUCTION')
+    and date <= (select max(through_date) from search_rollup_watermarks where table_name = 'search_term_vertical_daily')
+    and business_id = {b}
+    and experience_key = '{e}'
+    and current_cluster_search_terms.cluster_name = '{s}'
+group by 1, 2, 3
+"""
+
+SOURCE_ROLLUP_QUERY = """
+select
+    query_source,
+    traffic_source,
+    version_label,
+    sum(searches) as searches,
+    hll_combine(sessions_hll) as sessions_hll,
+    sum(clicks) as clicks,
+    sum(clicked_searches) as clicked_searches
+from search_term_daily
+where
+    date > dateadd('day', {d}, current_date())
+    and traffic_source in ('EXTERNAL', 'INTERNAL')
+    and version_label in ('STAGING', 'PRODUCTION')
+    and date <= (select max(through_date) from search_rollup_watermarks where table_name = 'search_term_daily')
+    and business_id = {b}
+    and experience_key = '{e}'
+    and search_term = '{s}'
+group by 1, 2, 3
+"""
+
+SOURCE_ROLLUP_QUERY_C = """
+select
+    query_source,
+    traffic_source,
+    version_label,
+    sum(searches) as searches,
+    hll_combine(sessions_hll) as sessions_hll,
+    sum(clicks) as clicks,
+    sum(clicked_searches) as clicked_searches
+from
+    search_term_daily
+    join current_cluster_search_terms using (business_id, experience_key, search_term)
+where
+    date > dateadd('day', {d}, current_date())
+    and traffic_source in ('EXTERNAL', 'INTERNAL')
+    and version_label in ('STAGING', 'PRODUCTION')
+    and date <= (select max(through_date) from search_rollup_watermarks where table_name = 'search_term_daily')
+    and business_id = {b}
+    and experience_key = '{e}'
+    and current_cluster_search_terms.cluster_name = '{s}'
+group by 1, 2, 3
+"""
+
+# Same queries for every popular search term or cluster at once ({terms}), keyed by a TERM column
+# and cut to each term's top 10 rows, so changing the selected term is served from one fetch
+ANALYTICS_BATCH_QUERY = """
+select
+    searches.tokenizer_normalized_query as term,
+    date(searches.timestamp) as date,
+    count(distinct user_data.session_id) as sessions,
+    count(distinct searches.query_id) as searches,
+    count(case when user_event_types.is_click_event then 1 end) as clicks,
+    round(div0(count(distinct case when user_event_types.is_click_event then searches.query_id end), count(distinct searches.query_id)), 2) as ctr,
+    round(div0(count(distinct case when searches.has_kg_results then searches.query_id end), count(distinct searches.query_id)), 2) as kg_result_rate
+from
+    searches
+    join user_data on searches.id = user_data.search_id
+    left join user_events on searches.id = user_events.search_id
+    left join user_event_types on user_events.user_event_type_id = user_event_types.id
+where
+    date(searches.timestamp) > dateadd('day', {d}, current_date())
+    and user_data.traffic_source {t}
+    and searches.version_label {l}
+    and searches.business_id = {b}
+    and searches.experience_key = '{e}'
+    and searches.tokenizer_normalized_query in ({terms})
+group by 1, 2
+order by 1
+"""
+
+ANALYTICS_BATCH_QUERY_C = """
+select
+    current_cluster_search_terms.cluster_name as term,
+    date(searches.timestamp) as date,
+    count(distinct user_data.session_id) as sessions,
+    count(distinct searches.query_id) as searches,
+    count(case when user_event_types.is_click_event then 1 end) as clicks,
+    round(div0(count(distinct case when user_event_types.is_click_event then searches.query_id end), count(distinct searches.query_id)), 2) as ctr,
+    round(div0(count(distinct case when searches.has_kg_results then searches.query_id end), count(distinct searches.query_id)), 2) as kg_result_rate
+from
+    searches
+    join user_data on searches.id = user_data.search_id
+    join current_cluster_search_terms on searches.business_id = current_cluster_search_terms.business_id and searches.experience_key = current_cluster_search_terms.experience_key and searches.tokenizer_normalized_query = current_cluster_search_terms.search_term
+    left join user_events on searches.id = user_events.search_id
+    left join user_event_types on user_events.user_event_type_id = user_event_types.id
+where
+    date(searches.timestamp) > dateadd('day', {d}, current_date())
+    and user_data.traffic_source {t}
+    and searches.version_label {l}
+    and searches.business_id = {b}
+    and searches.experience_key = '{e}'
+    and current_cluster_search_terms.cluster_name in ({terms})
+group by 1, 2
+order by 1
+"""
+
+CLUSTER_BATCH_QUERY = """
+with clusters as (
+    select search_term as term, business_id, experience_key, cluster_id
+    from current_cluster_search_terms
+    where
+        search_term in ({terms})
+        and business_id = {b}
+        and experience_key = '{e}'
+        and not is_noise
+        and not is_overlarge
+),
+cluster_terms as (
+    select
+        cluster_id,
+        search_term,
+        count(distinct searches.query_id) as searches,
+        count(distinct user_data.session_id) as sessions,
+        count(case when user_event_types.is_click_event then 1 end) as clicks,
+        round(div0(count(distinct case when user_event_types.is_click_event then searches.query_id end), count(distinct searches.query_id)), 2) as ctr
+    from
+        (select distinct business_id, experience_key, cluster_id from clusters) cluster
+        join current_cluster_search_terms using (business_id, experience_key, cluster_id)
+        left join searches on searches.business_id = cluster.business_id and searches.experience_key = cluster.experience_key and searches.tokenizer_normalized_query = current_cluster_search_terms.search_term
+        left join user_data on searches.id = user_data.search_id
+        left join user_events on searches.id = user_events.search_id
+        left join user_event_types on user_events.user_event_type_id = user_event_types.id
+    where
+        date(searches.timestamp) > dateadd('day', {d}, current_date())
+        and user_data.traffic_source {t}
+        and searches.version_label {l}
+    group by 1, 2
+)
+select clusters.term, cluster_terms.search_term, searches, sessions, clicks, ctr
+from
+    clusters
+    join cluster_terms on clusters.cluster_id = cluster_terms.cluster_id
+where cluster_terms.search_term != clusters.term
+qualify row_number() over (partition by clusters.term order by searches desc) <= 10
+order by 1, 3 desc
+"""
+
+CLUSTER_BATCH_QUERY_C = """
+select
+    current_cluster_search_terms.cluster_name as term,
+    current_cluster_search_terms.search_term,
+    count(distinct searches.query_id) as searches,
+    count(distinct user_data.session_id) as sessions,
+    count(case when user_event_types.is_click_event then 1 end) as clicks,
+    round(div0(count(distinct case when user_event_types.is_click_event then searches.query_id end), count(distinct searches.query_id)), 2) as ctr
+from
+    searches
+    join user_data on searches.id = user_data.search_id
+    join current_cluster_search_terms on searches.business_id = current_cluster_search_terms.business_id and searches.experience_key = current_cluster_search_terms.experience_key and searches.tokenizer_normalized_query = current_cluster_search_terms.search_term
+    left join user_events on searches.id = user_events.search_id
+    left join user_event_types on user_events.user_event_type_id = user_event_types.id
+where
+    date(searches.timestamp) > dateadd('day', {d}, current_date())
+    and user_data.traffic_source {t}
+    and searches.version_label {l}
+    and searches.business_id = {b}
+    and searches.experience_key = '{e}'
+    and current_cluster_search_terms.cluster_name in ({terms})
+group by 1, 2
+qualify row_number() over (partition by term order by count(distinct searches.query_id) desc) <= 10
+order by 1, 3 desc
+"""
+
+RESULTS_BATCH_QUERY = """
+select
+    searches.tokenizer_normalized_query as term,
+    results.entity_id,
+    count(distinct searches.query_id) as searches,
+    count(distinct user_data.session_id) as sessions,
+    count(case when user_event_types.is_click_event then 1 end) as clicks,
+    round(div0(count(distinct case when user_event_types.is_click_event then searches.query_id end), count(distinct searches.query_id)), 2) as ctr
+from
+    searches
+    left join user_data on searches.id = user_data.search_id
+    left join vertical_searchers on searches.id = vertical_searchers.search_id
+    left join results on vertical_searchers.id = results.vertical_searcher_id
+    left join user_events on searches.id = user_events.search_id and vertical_searchers.id = user_events.vertical_searcher_id and results.entity_id = user_events.entity_id
+    left join user_event_types on user_events.user_event_type_id = user_event_types.id
+where
+    date(searches.timestamp) > dateadd('day', {d}, current_date())
+    and user_data.traffic_source {t}
+    and searches.version_label {l}
+    and searches.business_id = {b}
+    and searches.experience_key = '{e}'
+    and searches.tokenizer_normalized_query in ({terms})
+group by 1, 2
+having clicks > 0
+qualify row_number() over (partition by term order by count(case when user_event_types.is_click_event then 1 end) desc, count(distinct searches.query_id) desc) <= 10
+order by 1, clicks desc, searches desc
+"""
+
+RESULTS_BATCH_QUERY_C = """
+select
+    current_cluster_search_terms.cluster_name as term,
+    results.entity_id,
+    count(distinct searches.query_id) as searches,
+    count(distinct user_data.session_id) as sessions,
+    count(case when user_event_types.is_click_event then 1 end) as clicks,
+    round(div0(count(distinct case when user_event_types.is_click_event then searches.query_id end), count(distinct searches.query_id)), 2) as ctr
+from
+    searches
+    join user_data on searches.id = user_data.search_id
+    join current_cluster_search_terms on searches.business_id = current_cluster_search_terms.business_id and searches.experience_key = current_cluster_search_terms.experience_key and searches.tokenizer_normalized_query = current_cluster_search_terms.search_term
+    left join vertical_searchers on searches.id = vertical_searchers.search_id
+    left join results on vertical_searchers.id = results.vertical_searcher_id
+    left join user_events on searches.id = user_events.search_id and vertical_searchers.id = user_events.vertical_searcher_id and results.entity_id = user_events.entity_id
+    left join user_event_types on user_events.user_event_type_id = user_event_types.id
+where
+    date(searches.timestamp) > dateadd('day', {d}, current_date())
+    and user_data.traffic_source {t}
+    and searches.version_label {l}
+    and searches.business_id = {b}
+    and searches.experience_key = '{e}'
+    and current_cluster_search_terms.cluster_name in ({terms})
+group by 1, 2
+having clicks > 0
+qualify row_number() over (partition by term order by count(case when user_event_types.is_click_event then 1 end) desc, count(distinct searches.query_id) desc) <= 10
+order by 1, clicks desc, searches desc
+"""
+
+VERTICALS_BATCH_QUERY = """
+select
+    searches.tokenizer_normalized_query as term,
+    vertical_searchers.vertical_id,
+    count(distinct searches.query_id) as searches,
+    count(distinct user_data.session_id) as sessions,
+    count(case when user_event_types.is_click_event then 1 end) as clicks,
+    div0(count(distinct case when user_event_types.is_click_event then searches.query_id end), count(distinct searches.query_id)) as ctr
+from
+    searches
+    left join user_data on searches.id = user_data.search_id
+    left join vertical_searchers on searches.id = vertical_searchers.search_id
+    left join user_events on searches.id = user_events.search_id and vertical_searchers.id = user_events.vertical_searcher_id
+    left join user_event_types on user_events.user_event_type_id = user_event_types.id
+where
+    date(searches.timestamp) > dateadd('day', {d}, current_date())
+    and user_data.traffic_source {t}
+    and searches.version_label {l}
+    and searches.business_id = {b}
+    and searches.experience_key = '{e}'
+    and searches.tokenizer_normalized_query in ({terms})
+group by 1, 2
+having clicks > 0
+qualify row_number() over (partition by term order by count(case when user_event_types.is_click_event then 1 end) desc, count(distinct searches.query_id) desc) <= 10
+order by 1, clicks desc, searches desc
+"""
+
+VERTICALS_BATCH_QUERY_C = """
+select
+    current_cluster_search_terms.cluster_name as term,
+    vertical_searchers.vertical_id,
+    count(distinct searches.query_id) as searches,
+    count(distinct user_data.session_id) as sessions,
+    count(case when user_event_types.is_click_event then 1 end) as clicks,
+    div0(count(distinct case when user_event_types.is_click_event then searches.query_id end), count(distinct searches.query_id)) as ctr
+from
+    searches
+    join user_data on searches.id = user_data.search_id
+    join current_cluster_search_terms on searches.business_id = current_cluster_search_terms.business_id and searches.experience_key = current_cluster_search_terms.experience_key and searches.tokenizer_normalized_query = current_cluster_search_terms.search_term
+    left join vertical_searchers on searches.id = vertical_searchers.search_id
+    left join user_events on searches.id = user_events.search_id and vertical_searchers.id = user_events.vertical_searcher_id
+    left join user_event_types on user_events.user_event_type_id = user_event_types.id
+where
+    date(searches.timestamp) > dateadd('day', {d}, current_date())
+    and user_data.traffic_source {t}
+    and searches.version_label {l}
+    and searches.business_id = {b}
+    and searches.experience_key = '{e}'
+    and current_cluster_search_terms.cluster_name in ({terms})
+group by 1, 2
+having clicks > 0
+qualify row_number() over (partition by term order by count(case when user_event_types.is_click_event then 1 end) desc, count(distinct searches.query_id) desc) <= 10
+order by 1, clicks desc, searches desc
+"""
+
+SOURCE_BATCH_QUERY = """
+select
+    searches.tokenizer_normalized_query as term,
+    user_data.query_source,
+    count(distinct searches.query_id) as searches,
+    count(distinct user_data.session_id) as sessions,
+    count(case when user_event_types.is_click_event then 1 end) as clicks,
+    div0(count(distinct case when user_event_types.is_click_event then searches.query_id end), count(distinct searches.query_id)) as ctr
+from
+    searches
+    left join user_data on searches.id = user_data.search_id
+    left join user_events on searches.id = user_events.search_id
+    left join user_event_types on user_events.user_event_type_id = user_event_types.id
+where
+    date(searches.timestamp) > dateadd('day', {d}, current_date())
+    and user_data.traffic_source {t}
+    and searches.version_label {l}
+    and searches.business_id = {b}
+    and searches.experience_key = '{e}'
+    and searches.tokenizer_normalized_query in ({terms})
+group by 1, 2
+having clicks > 0
+qualify row_number() over (partition by term order by count(case when user_event_types.is_click_event then 1 end) desc, count(distinct searches.query_id) desc) <= 10
+order by 1, clicks desc, searches desc
+"""
+
+SOURCE_BATCH_QUERY_C = """
+select
+    current_cluster_search_terms.cluster_name as term,
+    user_data.query_source,
+    count(distinct searches.query_id) as searches,
+    count(distinct user_data.session_id) as sessions,
+    count(case when user_event_types.is_click_event then 1 end) as clicks,
+    div0(count(distinct case when user_event_types.is_click_event then searches.query_id end), count(distinct searches.query_id)) as ctr
+from
+    searches
+    join user_data on searches.id = user_data.search_id
+    join current_cluster_search_terms on searches.business_id = current_cluster_search_terms.business_id and searches.experience_key = current_cluster_search_terms.experience_key and searches.tokenizer_normalized_query = current_cluster_search_terms.search_term
+    left join user_events on searches.id = user_events.search_id
+    left join user_event_types on user_events.user_event_type_id = user_event_types.id
+where
+    date(searches.timestamp) > dateadd('day', {d}, current_date())
+    and user_data.traffic_source {t}
+    and searches.version_label {l}
+    and searches.business_id = {b}
+    and searches.experience_key = '{e}'
+    and current_cluster_search_terms.cluster_name in ({terms})
+group by 1, 2
+having clicks > 0
+qualify row_number() over (partition by term order by count(case when user_event_types.is_click_event then 1 end) desc, count(distinct searches.query_id) desc) <= 10
+order by 1, clicks desc, searches desc
+"""
+
+LOGS_BATCH_QUERY = """
+select
+    searches.tokenizer_normalized_query as term,
+    searches.timestamp,
+    searches.query_id,
+    searches.tokenizer_normalized_query as query,
+    concat(user_data.city, ', ', user_data.region) as city,
+    user_data.country,
+    concat(user_data.latitude, ', ', user_data.longitude) as "LAT, LONG"
+from searches
+left join user_data on searches.id = user_data.search_id
+where
+    date(searches.timestamp) > dateadd('day', {d}, current_date())
+    and user_data.traffic_source {t}
+    and searches.version_label {l}
+    and searches.business_id = {b}
+    and searches.experience_key = '{e}'
+    and searches.tokenizer_normalized_query in ({terms})
+qualify row_number() over (partition by term order by searches.timestamp desc) <= 10
+order by 1, 2 desc
+"""
+
+LOGS_BATCH_QUERY_C = """
+select
+    current_cluster_search_terms.cluster_name as term,
+    searches.timestamp,
+    searches.query_id,
+    searches.tokenizer_normalized_query as query,
+    concat(user_data.city, ', ', user_data.region) as city,
+    user_data.country,
+    concat(user_data.latitude, ', ', user_data.longitude) as "LAT, LONG"
+from
+    searches
+    join user_data on searches.id = user_data.search_id
+    join current_cluster_search_terms on searches.business_id = current_cluster_search_terms.business_id and searches.experience_key = current_cluster_search_terms.experience_key and searches.tokenizer_normalized_query = current_cluster_search_terms.search_term
+where
+    date(searches.timestamp) > dateadd('day', {d}, current_date())
+    and user_data.traffic_source {t}
+    and searches.version_label {l}
+    and searches.business_id = {b}
+    and searches.experience_key = '{e}'
+    and current_cluster_search_terms.cluster_name in ({terms})
+qualify row_number() over (partition by term order by searches.timestamp desc) <= 10
+order by 1, 2 desc
+"""
+
+# Single scan of the filtered searches that produces the analytics and the per-tab aggregates
+# together, tagged by the PARAMS key they stand in for
+COMBINED_QUERY = """
+with base as (
+    select
+        searches.id,
+        searches.query_id,
+        searches.tokenizer_normalized_query,
+        searches.has_kg_results,
+        date(searches.timestamp) as date,
+        user_data.session_id,
+        user_data.query_source
+    from
+        searches
+        join user_data on searches.id = user_data.search_id
+    where
+        date(searches.timestamp) > dateadd('day', {d}, current_date())
+        and user_data.traffic_source {t}
+        and searches.version_label {l}
+        and searches.business_id = {b}
+        and searches.experience_key = '{e}'
+        and searches.tokenizer_normalized_query = '{s}'
+),
+events as (
+    select user_events.search_id, user_events.vertical_searcher_id, user_events.entity_id, user_event_types.is_click_event
+    from
+        base
+        join user_events on base.id = user_events.search_id
+        left join user_event_types on user_events.user_event_type_id = user_event_types.id
+),
+verticals as (
+    select vertical_searchers.id, vertical_searchers.search_id, vertical_searchers.vertical_id
+    from
+        base
+        join vertical_searchers on base.id = vertical_searchers.search_id
+)
+select
+    'analytics_query' as tab,
+    null as key,
+    base.date,
+    count(distinct base.session_id) as sessions,
+    count(distinct base.query_id) as searches,
+    count(case when events.is_click_event then 1 end) as clicks,
+    round(div0(count(distinct case when events.is_click_event then base.query_id end), count(distinct base.query_id)), 2) as ctr,
+    round(div0(count(distinct case when base.has_kg_results then base.query_id end), count(distinct base.query_id)), 2) as kg_result_rate
+from
+    base
+    left join events on base.id = events.search_id
+group by 3
+union all
+select * from (
+    select
+        'results_query' as tab,
+        to_varchar(results.entity_id) as key,
+        null as date,
+        count(distinct base.session_id) as sessions,
+        count(distinct base.query_id) as searches,
+        count(case when events.is_click_event then 1 end) as clicks,
+        round(div0(count(distinct case when events.is_click_event then base.query_id end), count(distinct base.query_id)), 2) as ctr,
+        null as kg_result_rate
+    from
+        base
+        left join verticals on base.id = verticals.search_id
+        left join results on verticals.id = results.vertical_searcher_id
+        left join events on base.id = events.search_id and verticals.id = events.vertical_searcher_id and results.entity_id = events.entity_id
+    group by 2
+    having clicks > 0
+    order by clicks desc, searches desc
+    limit 10
+)
+union all
+select * from (
+    select
+        'vertical_query' as tab,
+        verticals.vertical_id as key,
+        null as date,
+        count(distinct base.session_id) as sessions,
+        count(distinct base.query_id) as searches,
+        count(case when events.is_click_event then 1 end) as clicks,
+        div0(count(distinct case when events.is_click_event then base.query_id end), count(distinct base.query_id)) as ctr,
+        null as kg_result_rate
+    from
+        base
+        left join verticals on base.id = verticals.search_id
+        left join events on base.id = events.search_id and verticals.id = events.vertical_searcher_id
+    group by 2
+    having clicks > 0
+    order by clicks desc, searches desc
+    limit 10
+)
+union all
+select * from (
+    select
+        'source_query' as tab,
+        base.query_source as key,
+        null as date,
+        count(distinct base.session_id) as sessions,
+        count(distinct base.query_id) as searches,
+        count(case when events.is_click_event then 1 end) as clicks,
+        div0(count(distinct case when events.is_click_event then base.query_id end), count(distinct base.query_id)) as ctr,
+        null as kg_result_rate
+    from
+        base
+        left join events on base.id = events.search_id
+    group by 2
+    having clicks > 0
+    order by clicks desc, searches desc
+    limit 10
+)
+"""
+
+COMBINED_QUERY_C = """
+with base as (
+    select
+        searches.id,
+        searches.query_id,
+        searches.tokenizer_normalized_query,
+        searches.has_kg_results,
+        date(searches.timestamp) as date,
+        user_data.session_id,
+        user_data.query_source
+    from
+        searches
+        join user_data on searches.id = user_data.search_id
+        join current_cluster_search_terms on searches.business_id = current_cluster_search_terms.business_id and searches.experience_key = current_cluster_search_terms.experience_key and searches.tokenizer_normalized_query = current_cluster_search_terms.search_term
+    where
+        date(searches.timestamp) > dateadd('day', {d}, current_date())
+        and user_data.traffic_source {t}
+        and searches.version_label {l}
+        and searches.business_id = {b}
+        and searches.experience_key = '{e}'
+        and current_cluster_search_terms.cluster_name = '{s}'
+),
+events as (
+    select user_events.search_id, user_events.vertical_searcher_id, user_events.entity_id, user_event_types.is_click_event
+    from
+        base
+        join user_events on base.id = user_events.search_id
+        left join user_event_types on user_events.user_event_type_id = user_event_types.id
+),
+verticals as (
+    select vertical_searchers.id, vertical_searchers.search_id, vertical_searchers.vertical_id
+    from
+        base
+        join vertical_searchers on base.id = vertical_searchers.search_id
+)
+select
+    'analytics_query' as tab,
+    null as key,
+    base.date,
+    count(distinct base.session_id) as sessions,
+    count(distinct base.query_id) as searches,
+    count(case when events.is_click_event then 1 end) as clicks,
+    round(div0(count(distinct case when events.is_click_event then base.query_id end), count(distinct base.query_id)), 2) as ctr,
+    round(div0(count(distinct case when base.has_kg_results then base.query_id end), count(distinct base.query_id)), 2) as kg_result_rate
+from
+    base
+    left join events on base.id = events.search_id
+group by 3
+union all
+select * from (
+    select
+        'cluster_query' as tab,
+        base.tokenizer_normalized_query as key,
+        null as date,
+        count(distinct base.session_id) as sessions,
+        count(distinct base.query_id) as searches,
+        count(case when events.is_click_event then 1 end) as clicks,
+        round(div0(count(distinct case when events.is_click_event then base.query_id end), count(distinct base.query_id)), 2) as ctr,
+        null as kg_result_rate
+    from
+        base
+        left join events on base.id = events.search_id
+    group by 2
+    order by searches desc
+    limit 10
+)
+union all
+select * from (
+    select
+        'results_query' as tab,
+        to_varchar(results.entity_id) as key,
+        null as date,
+        count(distinct base.session_id) as sessions,
+        count(distinct base.query_id) as searches,
+        count(case when events.is_click_event then 1 end) as clicks,
+        round(div0(count(distinct case when events.is_click_event then base.query_id end), count(distinct base.query_id)), 2) as ctr,
+        null as kg_result_rate
+    from
+        base
+        left join verticals on base.id = verticals.search_id
+        left join results on verticals.id = results.vertical_searcher_id
+        left join events on base.id = events.search_id and verticals.id = events.vertical_searcher_id and results.entity_id = events.entity_id
+    group by 2
+    having clicks > 0
+    order by clicks desc, searches desc
+    limit 10
+)
+union all
+select * from (
+    select
+        'vertical_query' as tab,
+        verticals.vertical_id as key,
+        null as date,
+        count(distinct base.session_id) as sessions,
+        count(distinct base.query_id) as searches,
+        count(case when events.is_click_event then 1 end) as clicks,
+        div0(count(distinct case when events.is_click_event then base.query_id end), count(distinct base.query_id)) as ctr,
+        null as kg_result_rate
+    from
+        base
+        left join verticals on base.id = verticals.search_id
+        left join events on base.id = events.search_id and verticals.id = events.vertical_searcher_id
+    group by 2
+    having clicks > 0
+    order by clicks desc, searches desc
+    limit 10
+)
+union all
+select * from (
+    select
+        'source_query' as tab,
+        base.query_source as key,
+        null as date,
+        count(distinct base.session_id) as sessions,
+        count(distinct base.query_id) as searches,
+        count(case when events.is_click_event then 1 end) as clicks,
+        div0(count(distinct case when events.is_click_event then base.query_id end), count(distinct base.query_id)) as ctr,
+        null as kg_result_rate
+    from
+        base
+        left join events on base.id = events.search_id
+    group by 2
+    having clicks > 0
+    order by clicks desc, searches desc
+    limit 10
+)
+"""
+
+PARAMS = {
+    "popular_query": {
+        "Search Term": POPULAR_SEARCH_TERMS,
+        "Cluster": POPULAR_CLUSTERS,
+    },
+    "popular_query_col": {
+        "Search Term": "TOKENIZER_NORMALIZED_QUERY",
+        "Cluster": "CLUSTER_NAME",
+    },
+    "head": {"Search Term": "Search Terms", "Cluster": "Search Term Clusters"},
+    "url": {
+        "Search Term": "https://www.yext.com/s/{}/answers/experiences/{}/uniqueQueries",
+        "Cluster": "https://www.yext.com/s/{}/answers/experiences/{}/clusters",
+    },
+    "analytics_query": {
+        "Search Term": ANALYTICS_QUERY,
+        "Cluster": ANALYTICS_QUERY_C,
+    },
+    "cluster_query": {
+        "Search Term": CLUSTER_QUERY,
+        "Cluster": CLUSTER_QUERY_C,
+    },
+    "results_query": {
+        "Search Term": RESULTS_QUERY,
+        "Cluster": RESULTS_QUERY_C,
+    },
+    "vertical_query": {
+        "Search Term": VERTICALS_QUERY,
+        "Cluster": VERTICALS_QUERY_C,
+    },
+    "source_query": {
+        "Search Term": SOURCE_QUERY,
+        "Cluster": SOURCE_QUERY_C,
+    },
+    "logs_query": {
+        "Search Term": LOGS_QUERY,
+        "Cluster": LOGS_QUERY_C,
+    },
+    "combined_query": {
+        "Search Term": COMBINED_QUERY,
+        "Cluster": COMBINED_QUERY_C,
+    },
+    "combined_query_keys": {
+        "Search Term": ["analytics_query", "results_query", "vertical_query", "source_query"],
+        "Cluster": [
+            "analytics_query",
+            "cluster_query",
+            "results_query",
+            "vertical_query",
+            "source_query",
+        ],
+    },
+}
+
+# (soft, hard) TTLs in seconds for each query's cached results. Past the soft TTL a result is still
+# served, marked as stale, while it's refreshed in the background; past the hard TTL it's re-run.
+QUERY_TTLS = {
+    "default": (600, 3600),
+    "popular_query": (3600, 24 * 3600),
+    "logs_query": (300, 1800),
+}
+
+# Detail query run for each tab on the Search Term page
+TAB_QUERIES = {
+    "Related Search Terms": "cluster_query",
+    "Most Popular Results": "results_query",
+    "Most Popular Verticals": "vertical_query",
+    "Integration Source": "source_query",
+    "Search Logs": "logs_query",
+}
+
+# Bytes scanned by finished queries, for the query stats, looked up for a batch of query IDs at
+# once (the {ids} placeholder becomes one bind variable per ID)
+QUERY_HISTORY_QUERY = """
+select query_id, bytes_scanned
+from table(information_schema.query_history_by_user(result_limit => 10000))
+where query_id in ({ids})
+"""
+
+# Run queries with bind variables (Snowflake's numeric style) instead of formatting the filter into
+# the SQL, so every term and filter shares one SQL text per template: Snowflake reuses its compiled
+# plan and result cache, and quotes in terms can't break the SQL
+BIND_PARAMETERS = True
+
+# Bind variables for placeholders standing for more than one value: the traffic and label options'
+# values, and the popular terms (the popular queries' limit) in the batch queries
+BIND_COUNTS = {"t": 2, "l": 2, "terms": 50}
+
+# Query timing and cost stats, one JSON line per record
+METRICS_PATH = ".cache/query_metrics.jsonl"
+# Size the metrics file is rotated at, and seconds between batched bytes-scanned lookups
+METRICS_MAX_BYTES = 64 * 1024**2
+SCAN_LOOKUP_PERIOD = 60
+
+# Max number of Snowflake queries run concurrently (one cursor per worker)
+QUERY_WORKERS = 6
+
+# Max number of Yext searches run concurrently, and seconds a search response is reused for
+SEARCH_WORKERS = 4
+SEARCH_TTL = 600
+
+# Fill the hero metrics, chart, tab and test search as each one's data lands, rather than in page
+# order, and the max number of page parts loading at once across sessions
+PROGRESSIVE_RENDERING = True
+RENDER_WORKERS = 32
+# Figures and frames derived from results kept in memory, most recently used first
+RENDER_MEMO_SIZE = 256
+# Rows shown per page of a tab's table
+TABLE_PAGE_ROWS = 100
+
+# Entity id -> name index for result names, ids per Yext entities request (the API's page size),
+# and seconds before a name, or an id the API didn't return, is fetched again
+ENTITY_INDEX_PATH = ".cache/entity_names.sqlite"
+ENTITY_BATCH = 50
+ENTITY_TTL = 24 * 3600
+ENTITY_MISS_TTL = 600
+
+# Snowflake connections kept open across sessions, and seconds to wait for a free one
+POOL_SIZE = 8
+POOL_TIMEOUT = 30
+
+# Queries admitted to HUMAN_WH at once across sessions; the rest wait, most urgent first
+WAREHOUSE_CONCURRENCY = 6
+
+# Terms warmed in the background after a page renders (the next ones down the popular list), the
+# threads that warm them, and the speculative queries allowed per minute across sessions
+SPECULATIVE_TERMS = 3
+SPECULATIVE_WORKERS = 2
+SPECULATIVE_BUDGET = 30
+
+# Fetch the analytics (and dimension logs) once for the widest date window and derive the
+# selected window locally
+DERIVE_DATE_WINDOWS = True
+
+# Top up cached daily results with only the days since the last complete one when they go stale
+INCREMENTAL_REFRESH = True
+
+# Fetch the results for every traffic source and configuration label option at once (a row per
+# grouping set of the two, the tabs cut to their top 10 rows in each) and select the options' rows
+# locally (takes precedence over COMBINED_QUERIES)
+DIMENSION_FILTERS = True
+
+# Serve the analytics and tab aggregates from one combined query instead of one query each
+COMBINED_QUERIES = False
+
+# Fetch the analytics and tabs for every popular search term or cluster at once, so browsing the
+# popular list is served from cache. Off by default: the batch queries aren't per dimension or
+# daily, so they take precedence over DIMENSION_FILTERS and the date windows, and every filter or
+# date change runs the whole batch again instead of being served from cache.
+BATCH_POPULAR_TERMS = False
+
+BATCH_PARAMS = {
+    "analytics_query": {
+        "Search Term": ANALYTICS_BATCH_QUERY,
+        "Cluster": ANALYTICS_BATCH_QUERY_C,
+    },
+    "cluster_query": {
+        "Search Term": CLUSTER_BATCH_QUERY,
+        "Cluster": CLUSTER_BATCH_QUERY_C,
+    },
+    "results_query": {
+        "Search Term": RESULTS_BATCH_QUERY,
+        "Cluster": RESULTS_BATCH_QUERY_C,
+    },
+    "vertical_query": {
+        "Search Term": VERTICALS_BATCH_QUERY,
+        "Cluster": VERTICALS_BATCH_QUERY_C,
+    },
+    "source_query": {
+        "Search Term": SOURCE_BATCH_QUERY,
+        "Cluster": SOURCE_BATCH_QUERY_C,
+    },
+    "logs_query": {
+        "Search Term": LOGS_BATCH_QUERY,
+        "Cluster": LOGS_BATCH_QUERY_C,
+    },
+}
+
+DIMENSION_PARAMS = {
+    "analytics_query": {
+        "Search Term": ANALYTICS_DIMS_QUERY,
+        "Cluster": ANALYTICS_DIMS_QUERY_C,
+    },
+    "cluster_query": {
+        "Search Term": CLUSTER_DIMS_QUERY,
+        "Cluster": CLUSTER_DIMS_QUERY_C,
+    },
+    "results_query": {
+        "Search Term": RESULTS_DIMS_QUERY,
+        "Cluster": RESULTS_DIMS_QUERY_C,
+    },
+    "vertical_query": {
+        "Search Term": VERTICALS_DIMS_QUERY,
+        "Cluster": VERTICALS_DIMS_QUERY_C,
+    },
+    "source_query": {
+        "Search Term": SOURCE_DIMS_QUERY,
+        "Cluster": SOURCE_DIMS_QUERY_C,
+    },
+    "logs_query": {
+        "Search Term": LOGS_DIMS_QUERY,
+        "Cluster": LOGS_DIMS_QUERY_C,
+    },
+}
+
+# Fetch the sessions of the daily analytics as HLL sketches and merge them locally, so sessions are
+# counted once across the days of a window (estimates, within a few percent). Off until
+# tests/test_hll.py has passed against sketches exported by Snowflake (see
+# tests/capture_snowflake_hll.py); without it a window's sessions are the sum of its days'.
+SKETCH_SESSIONS = False
+
+# Distinct session counts replaced by sketches in the raw and rollup queries (see sketch_query)
+SKETCH_REWRITES = [
+    (
+        "count(distinct user_data.session_id) as sessions",
+        "hll_export(hll_accumulate(user_data.session_id)) as sessions_hll",
+    ),
+    (
+        "count(distinct session_id) as sessions",
+        "hll_export(hll_accumulate(session_id)) as sessions_hll",
+    ),
+    (
+        "hll_estimate(hll_combine(sessions_hll)) as sessions",
+        "hll_export(hll_combine(sessions_hll)) as sessions_hll",
+    ),
+]
+
+# Read the analytics and aggregate tabs from the daily rollup tables when the rollup job
+# (`python rollup.py`, e.g. hourly) maintains them, falling back to the raw tables for the days
+# since it last ran. Served like the dimension queries (takes precedence over BATCH_POPULAR_TERMS).
+ROLLUP_QUERIES = False
+
+# Days of rollups kept, enough for every date window
+ROLLUP_DAYS = -WIDEST_DATE_OFFSET
+
+# Rollup table read for each PARAMS query
+ROLLUP_TABLES = {
+    "analytics_query": "search_term_daily",
+    "cluster_query": "search_term_daily",
+    "results_query": "search_term_entity_daily",
+    "vertical_query": "search_term_vertical_daily",
+    "source_query": "search_term_daily",
+}
+
+ROLLUP_READS = {
+    "analytics_query": {
+        "Search Term": ANALYTICS_ROLLUP_QUERY,
+        "Cluster": ANALYTICS_ROLLUP_QUERY_C,
+    },
+    "cluster_query": {
+        "Search Term": CLUSTER_ROLLUP_QUERY,
+        "Cluster": CLUSTER_ROLLUP_QUERY_C,
+    },
+    "results_query": {
+        "Search Term": RESULTS_ROLLUP_QUERY,
+        "Cluster": RESULTS_ROLLUP_QUERY_C,
+    },
+    "vertical_query": {
+        "Search Term": VERTICALS_ROLLUP_QUERY,
+        "Cluster": VERTICALS_ROLLUP_QUERY_C,
+    },
+    "source_query": {
+        "Search Term": SOURCE_ROLLUP_QUERY,
+        "Cluster": SOURCE_ROLLUP_QUERY_C,
+    },
+}
+
+# Raw per_search aggregates rewritten for the raw part of a rollup query, which keeps sessions as
+# sketches, and for the total of both parts
+ROLLUP_PARTS = [
+    ("count(distinct session_id) as sessions", "hll_accumulate(session_id) as sessions_hll"),
+]
+ROLLUP_TOTALS = [
+    (
+        "count(distinct session_id) as sessions",
+        "hll_estimate(hll_combine(sessions_hll)) as sessions",
+    ),
+    ("count(*) as searches", "sum(searches) as searches"),
+    (
+        "count(case when clicks > 0 then 1 end) as clicked_searches",
+        "sum(clicked_searches) as clicked_searches",
+    ),
+    ("count(case when has_kg_results then 1 end) as kg_searches", "sum(kg_searches) as kg_searches"),
+    ("count(*)", "sum(searches)"),
+]
+
+ROLLUP_PARAMS = {
+    key: {mode: rollup_query(key, mode) for mode in reads} for key, reads in ROLLUP_READS.items()
+}
+
+# Dimension values selected by each traffic and label option
+DIMENSION_VALUES = {
+    "All Traffic": ["EXTERNAL", "INTERNAL"],
+    "External": ["EXTERNAL"],
+    "Internal": ["INTERNAL"],
+    "All Configuration Labels": ["STAGING", "PRODUCTION"],
+    "STAGING": ["STAGING"],
+    "PRODUCTION": ["PRODUCTION"],
+}
+
+# Columns returned by each PARAMS query, in order
+QUERY_COLUMNS = {
+    "analytics_query": ["DATE", "SESSIONS", "SEARCHES", "CLICKS", "CTR", "KG_RESULT_RATE"],
+    "cluster_query": ["SEARCH_TERM", "SEARCHES", "SESSIONS", "CLICKS", "CTR"],
+    "results_query": ["ENTITY_ID", "SEARCHES", "SESSIONS", "CLICKS", "CTR"],
+    "vertical_query": ["VERTICAL_ID", "SEARCHES", "SESSIONS", "CLICKS", "CTR"],
+    "source_query": ["QUERY_SOURCE", "SEARCHES", "SESSIONS", "CLICKS", "CTR"],
+    "logs_query": ["TIMESTAMP", "QUERY_ID", "QUERY", "CITY", "COUNTRY", "LAT, LONG"],
+}
+
+# On-disk results cache, shared by every process that uses the same path
+CACHE_PATH = ".cache/search_term_details.sqlite"
+# Incrementally refreshed results are kept past their hard TTL, since topping them up is cheap
+INCREMENTAL_TTL = 7 * 24 * 3600
+CACHE_TTL = max([INCREMENTAL_TTL] + [hard for _, hard in QUERY_TTLS.values()])
+CACHE_MAX_BYTES = 2 * 1024**3
+# Results also kept in memory by each process, least recently used first out past the budget
+MEMORY_CACHE_BYTES = 512 * 1024**2
+
+# Low-cardinality text columns, kept dictionary-encoded
+CATEGORY_COLUMNS = ["SEARCH_TERM", "VERTICAL_ID", "QUERY_SOURCE", "TRAFFIC_SOURCE", "VERSION_LABEL"]